@@ -0,0 +1,139 @@
+#
+# atactk: ATAC-seq toolkit
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+#
+
+"""
+Compiled reading of the alignments in a region, through pysam's C API.
+
+Use :func:`atactk.metrics.common.fetch_segment_arrays` instead; it
+calls this when the extension has been built.
+"""
+
+import numpy as np
+
+from libc.stdint cimport int64_t, uint8_t
+from libc.stdlib cimport free, realloc
+from pysam.libcalignmentfile cimport AlignmentFile
+from pysam.libchtslib cimport (
+    BAM_FREVERSE, bam1_t, bam_destroy1, bam_endpos, bam_init1, hts_itr_destroy, hts_itr_t, hts_set_cache_size, sam_itr_next,
+    sam_itr_queryi,
+)
+
+
+# bytes of decompressed BGZF blocks to keep; neighbouring features are
+# usually in the same blocks, which otherwise are decompressed for each
+DEFAULT_BLOCK_CACHE_SIZE = 1 << 24
+
+
+cdef struct segment_buffer:
+    Py_ssize_t length
+    Py_ssize_t capacity
+    int64_t *reference_starts
+    int64_t *reference_ends
+    int64_t *fragment_lengths
+    uint8_t *is_reverse
+
+
+cdef int grow(segment_buffer *buffer) nogil:
+    """
+    Double the capacity of `buffer`, returning -1 if memory runs out.
+    """
+    cdef Py_ssize_t capacity = buffer.capacity * 2 if buffer.capacity else 1024
+    cdef void *p
+
+    p = realloc(buffer.reference_starts, capacity * sizeof(int64_t))
+    if p == NULL:
+        return -1
+    buffer.reference_starts = <int64_t *> p
+
+    p = realloc(buffer.reference_ends, capacity * sizeof(int64_t))
+    if p == NULL:
+        return -1
+    buffer.reference_ends = <int64_t *> p
+
+    p = realloc(buffer.fragment_lengths, capacity * sizeof(int64_t))
+    if p == NULL:
+        return -1
+    buffer.fragment_lengths = <int64_t *> p
+
+    p = realloc(buffer.is_reverse, capacity * sizeof(uint8_t))
+    if p == NULL:
+        return -1
+    buffer.is_reverse = <uint8_t *> p
+
+    buffer.capacity = capacity
+    return 0
+
+
+def fetch_segment_arrays(AlignmentFile alignment_file, reference, int64_t start, int64_t end,
+                         const uint8_t[::1] flag_filter_table, int quality):
+    """
+    Read the aligned segments overlapping a region straight into arrays.
+
+    See :func:`atactk.metrics.common.fetch_segment_arrays`, which
+    calls this with the table from
+    :func:`atactk.data.make_flag_filter_table` viewed as unsigned
+    bytes.
+    """
+    cdef int tid = alignment_file.get_tid(reference)
+    cdef hts_itr_t *iterator
+    cdef bam1_t *b
+    cdef segment_buffer buffer
+    cdef int status = 0
+    cdef Py_ssize_t i
+
+    if tid < 0:
+        raise ValueError('invalid contig `{}`'.format(reference))
+
+    hts_set_cache_size(alignment_file.htsfile, DEFAULT_BLOCK_CACHE_SIZE)
+    iterator = sam_itr_queryi(alignment_file.index, tid, start, end)
+    if iterator == NULL:
+        raise ValueError('could not fetch {}:{}-{}'.format(reference, start, end))
+
+    b = bam_init1()
+    buffer.length = buffer.capacity = 0
+    buffer.reference_starts = buffer.reference_ends = buffer.fragment_lengths = NULL
+    buffer.is_reverse = NULL
+
+    try:
+        with nogil:
+            while sam_itr_next(alignment_file.htsfile, iterator, b) >= 0:
+                if b.core.qual < quality or not flag_filter_table[b.core.flag]:
+                    continue
+                if buffer.length == buffer.capacity and grow(&buffer) < 0:
+                    status = -1
+                    break
+                i = buffer.length
+                buffer.reference_starts[i] = b.core.pos
+                buffer.reference_ends[i] = bam_endpos(b)
+                buffer.fragment_lengths[i] = b.core.isize
+                buffer.is_reverse[i] = (b.core.flag & BAM_FREVERSE) != 0
+                buffer.length += 1
+
+        if status < 0:
+            raise MemoryError()
+
+        reference_starts = np.empty(buffer.length, dtype=np.int64)
+        reference_ends = np.empty(buffer.length, dtype=np.int64)
+        fragment_lengths = np.empty(buffer.length, dtype=np.int64)
+        is_reverse = np.empty(buffer.length, dtype=np.bool_)
+        if buffer.length:
+            reference_starts[:] = <int64_t[:buffer.length]> buffer.reference_starts
+            reference_ends[:] = <int64_t[:buffer.length]> buffer.reference_ends
+            fragment_lengths[:] = <int64_t[:buffer.length]> buffer.fragment_lengths
+            is_reverse.view(np.uint8)[:] = <uint8_t[:buffer.length]> buffer.is_reverse
+    finally:
+        free(buffer.reference_starts)
+        free(buffer.reference_ends)
+        free(buffer.fragment_lengths)
+        free(buffer.is_reverse)
+        bam_destroy1(b)
+        hts_itr_destroy(iterator)
+
+    return reference_starts, reference_ends, fragment_lengths, is_reverse
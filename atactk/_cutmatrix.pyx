@@ -0,0 +1,63 @@
+#
+# atactk: ATAC-seq toolkit
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+#
+
+"""
+Compiled versions of the cut point counting in :mod:`atactk.metrics.cut`.
+
+Use the functions in that module instead; they call these when the
+extension has been built.
+"""
+
+import numpy as np
+
+from libc.stdint cimport int64_t, uint8_t
+
+
+def count_cut_points_in_bins(
+    const int64_t[::1] cut_points,
+    const int64_t[::1] fragment_sizes,
+    const uint8_t[::1] is_reverse,
+    const int64_t[:, ::1] bins,
+    int64_t start,
+    int64_t end,
+    bint feature_is_reverse,
+):
+    """
+    Count cut points at each position in a region, for each fragment size bin and strand.
+
+    See :func:`atactk.metrics.cut.count_cut_points_in_bins`, which
+    calls this with `is_reverse` viewed as unsigned bytes. Cut points
+    outside the region are ignored.
+    """
+    cdef Py_ssize_t length = end - start
+    cdef Py_ssize_t b, i, position
+    cdef int strand
+    cdef int64_t minimum_length, maximum_length
+
+    counts_array = np.zeros((bins.shape[0], 2, length), dtype=np.int64)
+    cdef int64_t[:, :, ::1] counts = counts_array
+
+    with nogil:
+        for b in range(bins.shape[0]):
+            minimum_length = bins[b, 0]
+            maximum_length = bins[b, 1]
+            for i in range(cut_points.shape[0]):
+                position = cut_points[i] - start
+                # bounds checking is off, so positions outside the region are skipped here
+                if position < 0 or position >= length:
+                    continue
+                if minimum_length <= fragment_sizes[i] <= maximum_length:
+                    strand = 1 if is_reverse[i] else 0
+                    if feature_is_reverse:
+                        strand = 1 - strand
+                        position = length - 1 - position
+                    counts[b, strand, position] += 1
+
+    return counts_array
@@ -0,0 +1,112 @@
+#
+# atactk: ATAC-seq toolkit
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+#
+
+"""
+Compiled version of the fuzzy alignment in the ``trim_adapters`` script.
+
+Use the script's ``fuzzy_align`` instead; it calls this when the
+extension has been built.
+"""
+
+from libc.stdlib cimport free, malloc
+
+
+cdef int bounded_distance(const unsigned char *a, Py_ssize_t a_length, const unsigned char *b, Py_ssize_t b_length,
+                          int cutoff, int *previous, int *current) nogil:
+    """
+    Return the edit distance between `a` and `b`, or `cutoff + 1` if it exceeds `cutoff`.
+
+    `previous` and `current` must each have room for `b_length + 1` values.
+    """
+    cdef Py_ssize_t i, j
+    cdef int cost, distance, row_minimum
+    cdef int *swap
+
+    if a_length - b_length > cutoff or b_length - a_length > cutoff:
+        return cutoff + 1
+
+    for j in range(b_length + 1):
+        previous[j] = j
+
+    for i in range(1, a_length + 1):
+        current[0] = i
+        row_minimum = i
+        for j in range(1, b_length + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            distance = previous[j - 1] + cost
+            if previous[j] + 1 < distance:
+                distance = previous[j] + 1
+            if current[j - 1] + 1 < distance:
+                distance = current[j - 1] + 1
+            current[j] = distance
+            if distance < row_minimum:
+                row_minimum = distance
+
+        # no later row can have a smaller distance than this one's minimum
+        if row_minimum > cutoff:
+            return cutoff + 1
+
+        swap = previous
+        previous = current
+        current = swap
+
+    if previous[b_length] > cutoff:
+        return cutoff + 1
+    return previous[b_length]
+
+
+def fuzzy_align(bytes search_seq, bytes target_seq, int max_distance):
+    """
+    Align with a limit on edit distance.
+
+    Returns the position and edit distance of the best alignment of
+    `search_seq` in `target_seq`, the first found if there are several,
+    or `(None, None)` if there is none within `max_distance`.
+    """
+    cdef const unsigned char *search = search_seq
+    cdef const unsigned char *target = target_seq
+    cdef Py_ssize_t search_length = len(search_seq)
+    cdef Py_ssize_t target_length = len(target_seq)
+    cdef Py_ssize_t i, window_length
+    cdef Py_ssize_t best_index = -1
+    cdef int best_distance = -1
+    cdef int cutoff = max_distance
+    cdef int distance
+
+    cdef int *previous = <int *> malloc((search_length + 1) * sizeof(int))
+    cdef int *current = <int *> malloc((search_length + 1) * sizeof(int))
+    if previous == NULL or current == NULL:
+        free(previous)
+        free(current)
+        raise MemoryError()
+
+    try:
+        with nogil:
+            for i in range(target_length):
+                # the sliding window is the size of search_seq, except near the end of target_seq
+                window_length = search_length
+                if window_length > target_length - i:
+                    window_length = target_length - i
+
+                distance = bounded_distance(target + i, window_length, search, search_length, cutoff, previous, current)
+                if distance <= cutoff:
+                    best_index = i
+                    best_distance = distance
+                    if distance == 0:
+                        break
+                    # a later alignment is only better if it's closer
+                    cutoff = distance - 1
+    finally:
+        free(previous)
+        free(current)
+
+    if best_index < 0:
+        return None, None
+    return best_index, best_distance
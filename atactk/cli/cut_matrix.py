@@ -1,5 +1,3 @@
-#!/usr/bin/env python
-
 #
 # make_cut_matrix: Given a BAM file containing alignments from an
 # ATAC-seq experiment and a BED file of motifs, creates a matrix of the
@@ -16,12 +14,13 @@ import argparse
 import decimal
 import logging
 import os
-import signal
 import sys
 import time
 import textwrap
 import traceback
 
+import numpy
+
 import atactk.command
 import atactk.data
 import atactk.metrics
@@ -31,6 +30,8 @@ import atactk.util
 
 LOGGING_FORMAT = '%(levelname)s %(message)s'
 
+logger = logging.getLogger('make_cut_matrix')
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -127,42 +128,28 @@ def print_discrete_matrix(scored_motifs):
     return motif_count
 
 
-def print_aggregate_matrix(scored_motifs, aggregate_positions, bins):
+def print_aggregate_matrix(motif_count, matrix, aggregate_positions, bins, extension):
     strands = ('F', 'R')
 
     if not bins:
         bins = [[('All', None, None)]]
         strands = ['Both']
 
-    matrix = {}
-    for position in aggregate_positions:
-        matrix[position] = {}
-        for bin_group in bins:
-            bin_group_key = atactk.util.make_bin_group_key(bin_group)
-            matrix[position][bin_group_key] = {}
-            for strand in strands:
-                matrix[position][bin_group_key][strand] = 0
-
-    for motif_count, scored_motif in enumerate(scored_motifs, 1):
-        motif, row, tree = scored_motif
-        for position in tree.keys():
-            for bin_group_key in tree[position].keys():
-                for strand in strands:
-                    try:
-                        count = tree[position][bin_group_key][strand]
-                        matrix[position][bin_group_key][strand] += count
-                    except KeyError:
-                        pass  # no count to add
+    # the matrix is the sum of the trees returned by atactk.metrics.cut.score_feature_with_cut_points, which are arrays
+    # of counts by bin group, strand, and position in the extended region
+    if matrix is None:
+        matrix = numpy.zeros((len(bins), len(strands), 2 * extension), dtype=numpy.int64)
 
     decimal_motif_count = decimal.Decimal(motif_count)
     print('Position\tFragmentSizeBin\tStrand\tCutPointCount\tCutPointCountFraction')
-    for position, fragment_size_bins in sorted(matrix.items()):
-        for fragment_size_bin, strands in sorted(fragment_size_bins.items(), key=lambda item: '_' in item and int(item[0].split('_')[0])):
-            for strand, count in sorted(strands.items()):
+    for position in aggregate_positions:
+        index = position + extension
+        for g, bin_group in enumerate(bins):
+            fragment_size_bin = atactk.util.make_bin_group_key(bin_group)
+            for s, strand in sorted(enumerate(strands), key=lambda item: item[1]):
+                count = int(matrix[g, s, index]) if index < matrix.shape[2] else 0
                 print('{}\t{}\t{}\t{:d}\t{}'.format(position, fragment_size_bin, strand, count, count / decimal_motif_count))
 
-    return motif_count
-
 
 def make_cut_matrix(args):
     job_start = time.time()
@@ -193,16 +180,15 @@ def make_cut_matrix(args):
     motif_count = 0
 
     aggregate_positions = range(0 - args.extension, args.extension + 1)
-    pool = None
 
     try:
         logger.info('Making {} cut point matrix...'.format(args.discrete and 'discrete' or 'aggregate'))
-        scored_motifs = atactk.metrics.cut.score_features_with_cut_points(args.alignments, args.bins, args.include_flags, args.exclude_flags, args.quality, args.cut_point_offset, motifs, args.parallel)
-
         if args.discrete:
+            scored_motifs = atactk.metrics.cut.score_features_with_cut_points(args.alignments, args.bins, args.include_flags, args.exclude_flags, args.quality, args.cut_point_offset, motifs, args.parallel)
             motif_count = print_discrete_matrix(scored_motifs)
         elif args.aggregate:
-            motif_count = print_aggregate_matrix(scored_motifs, aggregate_positions, args.bins)
+            motif_count, matrix = atactk.metrics.cut.aggregate_features_with_cut_points(args.alignments, args.bins, args.include_flags, args.exclude_flags, args.quality, args.cut_point_offset, motifs, args.parallel)
+            print_aggregate_matrix(motif_count, matrix, aggregate_positions, args.bins, args.extension)
 
         if not motif_count:
             logger.warn("""No motifs were found in the BED input. Make sure it is in the format\nspecified in this program's help and at https://genome.ucsc.edu/FAQ/FAQformat.html.""")
@@ -212,18 +198,8 @@ def make_cut_matrix(args):
 
         logger.info('Processed {:.0f} feature{} in {}'.format(motif_count, motif_count == 1 and '' or 's', atactk.util.humanize_time(time.time() - job_start)))
     except KeyboardInterrupt:
+        # the scoring functions have already terminated their worker processes
         logger.info('Keyboard interrupt received in process {}.'.format(os.getpid()))
-
-        if pool:
-            if sys.version_info.major < 3:
-                logger.warn('Interrupt handling in multiprocessing programs is not reliable before Python 3, so I may have to exit without cleaning up all worker processes. Sorry.')
-                signal.signal(signal.SIGALRM, atactk.util.exit_forcefully)
-                signal.alarm(10)
-
-            logger.info('Telling worker processes to terminate...')
-            pool.terminate()
-            logger.info('Waiting for worker processes to terminate...')
-            pool.join()
         logger.info('Exiting.')
         sys.exit(1)
     except Exception as e:
@@ -234,14 +210,17 @@ def make_cut_matrix(args):
         sys.exit(1)
 
 
-if __name__ == '__main__':
+def main():
     args = parse_arguments()
 
     loglevel = args.verbose and logging.DEBUG or logging.INFO
     logging.basicConfig(level=loglevel, format=LOGGING_FORMAT)
-    logger = logging.getLogger('make_cut_matrix')
 
     bins = sorted([b for bins in args.bins for b in bins])
     atactk.command.check_bin_resolutions(bins, args.extension)
 
     make_cut_matrix(args)
+
+
+if __name__ == '__main__':
+    main()
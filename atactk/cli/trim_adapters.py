@@ -1,5 +1,3 @@
-#!/usr/bin/env python
-
 #
 # Trims putative adapter sequence from two files containing paired end
 # reads.
@@ -15,10 +13,15 @@ import gzip
 import os
 import re
 
-import Levenshtein
+from rapidfuzz.distance import Levenshtein
 
 import atactk.data
 
+try:
+    import atactk._trim as _trim
+except ImportError:
+    _trim = None
+
 
 FQ_FILENAME_RE = re.compile('^(?P<basename>[^/]+)\.(?P<fq>f(?:ast)?q)*(?P<gz>\.gz)*$')
 
@@ -39,28 +42,44 @@ def fuzzy_align(search_seq, target_seq, max_distance):
 
     Returns the first alignment found.
 
+    If the :mod:`atactk._trim` extension was built when ``atactk`` was
+    installed, it does the alignment. The sequences can be :class:`str`
+    or :class:`bytes`, as rapidfuzz accepts either, but the extension
+    only takes bytes.
+
     """
 
+    if _trim is not None:
+        # latin-1 encodes each character as one byte, so the alignment positions don't change
+        if isinstance(search_seq, str):
+            search_seq = search_seq.encode('latin-1')
+        if isinstance(target_seq, str):
+            target_seq = target_seq.encode('latin-1')
+        return _trim.fuzzy_align(search_seq, target_seq, max_distance)
+
     search_seq_len = len(search_seq)
-    alignments = []
+    alignment = None, None
+    cutoff = max_distance
 
-    for i, base in enumerate(target_seq):
+    for i in range(len(target_seq)):
         window = target_seq[i:i + search_seq_len]  # sliding window the size of search_seq
-        distance = Levenshtein.distance(window, search_seq)
-        if distance <= max_distance:
-            alignments.append((i, distance))
-
-    if alignments:
-        return sorted(alignments, key=lambda item: item[1])[0]
+        # with a cutoff, the distance calculation stops early once it can't be within the cutoff
+        distance = Levenshtein.distance(window, search_seq, score_cutoff=cutoff)
+        if distance <= cutoff:
+            alignment = i, distance
+            if distance == 0:
+                break
+            # a later alignment is only better if it's closer
+            cutoff = distance - 1
 
-    return None, None
+    return alignment
 
 
 def trim_record(rec, start=0, end=-1):
     return [rec[0], rec[1][start:end], rec[2], rec[3][start:end]]
 
 
-def trim_pair(pair):
+def trim_pair(pair, args):
     forward_read, reverse_read = pair
     #
     # try to align reads to themselves
@@ -73,6 +92,7 @@ def trim_pair(pair):
     try:
         idx = forward_read[1].rindex(reverse_read_rc)  # we have a winner!
     except ValueError:
+        idx = None
         if args.edit_distance > 0:
             # not a perfect match, so if mismatches are allowed, try a fuzzy match
             idx, distance = fuzzy_align(reverse_read_rc, forward_read[1], args.edit_distance)
@@ -81,16 +101,17 @@ def trim_pair(pair):
     if idx is not None and idx > 0:
         cut = idx + args.rc_length - args.fudge
 
-        forward_read = trim_record(forward_read, trim_start, cut)
-        reverse_read = trim_record(reverse_read, trim_start, cut)
+        forward_read = trim_record(forward_read, args.trim_start, cut)
+        reverse_read = trim_record(reverse_read, args.trim_start, cut)
 
-    forward_rec = ['{}\n'.format(i) for i in forward_read]
-    reverse_rec = ['{}\n'.format(i) for i in reverse_read]
+    # the reads are bytes, as are the trimmed files
+    forward_rec = [i + b'\n' for i in forward_read]
+    reverse_rec = [i + b'\n' for i in reverse_read]
     return forward_rec, reverse_rec
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Trim adapters from paired-end HTS reads.')
+def main():
+    parser = argparse.ArgumentParser(prog='trim_adapters', description='Trim adapters from paired-end HTS reads.')
     parser.add_argument('-d', '--max-edit-distance', type=int, default=1, dest='edit_distance', help='The maximum edit distance permitted when aligning the paired reads (default: 1).')
     parser.add_argument('-f', '--fudge', type=int, default=1, dest='fudge', help='An arbitrary number of extra bases to trim from the ends of reads (default: 1) because the original pyadapter_trim.py script did so.')
     parser.add_argument('-s', '--trim-from-start', type=int, default=0, dest='trim_start', help='Trim this number of bases from the start of each sequence (default: 0).')
@@ -101,14 +122,14 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    trim_start = args.trim_start
-
     pairs = atactk.data.make_fastq_pair_reader(args.forward, args.reverse)
 
-    forward_trimmed_file = gzip.open(make_trimmed_filename(args.forward), 'wt')
-    reverse_trimmed_file = gzip.open(make_trimmed_filename(args.reverse), 'wt')
+    with gzip.open(make_trimmed_filename(args.forward), 'wb') as forward_trimmed_file, gzip.open(make_trimmed_filename(args.reverse), 'wb') as reverse_trimmed_file:
+        for pair in pairs:
+            forward_rec, reverse_rec = trim_pair(pair, args)
+            forward_trimmed_file.writelines(forward_rec)
+            reverse_trimmed_file.writelines(reverse_rec)
 
-    for pair in pairs:
-        forward_rec, reverse_rec = trim_pair(pair)
-        forward_trimmed_file.writelines(forward_rec)
-        reverse_trimmed_file.writelines(reverse_rec)
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,9 @@ Code used in command-line applications.
 from __future__ import print_function
 
 import argparse
+import functools
 import logging
+import re
 import sys
 
 import sexpdata
@@ -22,6 +24,11 @@ import sexpdata
 import atactk
 
 
+# a bins string made only of groups of start-end bins followed by an integer resolution
+SIMPLE_BINS_STRING_RE = re.compile(r'^\s*(?:\(\s*(?:\d+-\d+\s+)+\d+\s*\)\s*)*$')
+BIN_GROUP_RE = re.compile(r'\(([^()]*)\)')
+
+
 def check_bins_for_overlap(bins):
     """
     Make sure bins don't overlap.
@@ -66,6 +73,33 @@ def check_bin_resolutions(bins, extension):
             logger.warn("Bin {:d}-{:d} resolution {:d} is not a divisor of extension {:d}".format(start, end, resolution, extension))
 
 
+def split_bin_groups(bins_string):
+    """
+    Split the string representing fragment size groups into the items of each group.
+
+    Strings of the usual form, like ``(36-149 1) (150-224 225-324 2)``,
+    are split with regular expressions. Anything else is left to
+    :mod:`sexpdata`, which is much slower, but will parse any
+    S-expression.
+
+    Parameters
+    ----------
+    bins_string: str
+       A list of S-expressions representing groups of bin start and end positions and resolutions.
+
+    Returns
+    -------
+    list
+       A list of lists, one per group, of the group's bins followed by its resolution.
+    """
+
+    if SIMPLE_BINS_STRING_RE.match(bins_string):
+        return [bin_group.split() for bin_group in BIN_GROUP_RE.findall(bins_string)]
+
+    bin_groups = sexpdata.loads('(' + bins_string + ')')
+    return [[item.value() if isinstance(item, sexpdata.Symbol) else item for item in bin_group] for bin_group in bin_groups]
+
+
 def parse_bins(bins_string):
     """
     Parse the string representing fragment size groups.
@@ -136,7 +170,12 @@ def parse_bins(bins_string):
        A list of lists of tuples of (start, end, resolution).
     """
 
-    bin_groups = sexpdata.loads('(' + bins_string + ')')
+    return [list(group) for group in _parse_bins(bins_string)]
+
+
+@functools.lru_cache(maxsize=16)
+def _parse_bins(bins_string):
+    bin_groups = split_bin_groups(bins_string)
 
     groups = []
     for g, bin_group in enumerate(bin_groups):
@@ -149,8 +188,7 @@ def parse_bins(bins_string):
             raise argparse.ArgumentTypeError("Resolution in bin group {} is not a positive integer.".format(g))
 
         for i, bin_string in enumerate(bin_group):
-            bin_string = bin_string.value()
-            bin = bin_string.split('-')
+            bin = str(bin_string).split('-')
             try:
                 if len(bin) != 2:
                     raise ValueError
@@ -162,12 +200,12 @@ def parse_bins(bins_string):
                 group.append((start, end, resolution))
             except ValueError:
                 raise argparse.ArgumentTypeError("Bin {} in group {} is malformed.".format(i, g))
-        groups.append(group)
+        groups.append(tuple(group))
 
     # flatten groups to just a list of bins, sort, check for overlaps
     bins = sorted([b for bins in groups for b in bins])
     check_bins_for_overlap(bins)
-    return groups
+    return tuple(groups)
 
 
 def version(program_name=''):
@@ -12,10 +12,18 @@ Code for reading and manipulating data commonly used in ATAC-seq pipelines.
 """
 
 import csv
+import functools
 import gzip
-import pysam
+import io
+import operator
+import os
+import shutil
+import subprocess
 import sys
 
+import numpy as np
+import pysam
+
 
 FEATURE_FIELDNAMES = [
     'reference',
@@ -39,6 +47,23 @@ NUCLEOTIDE_COMPLEMENTS = {
     "t": "a",
 }
 
+NUCLEOTIDE_COMPLEMENT_TABLE = str.maketrans(NUCLEOTIDE_COMPLEMENTS)
+NUCLEOTIDE_COMPLEMENT_BYTES_TABLE = bytes.maketrans(
+    ''.join(NUCLEOTIDE_COMPLEMENTS.keys()).encode('ascii'),
+    ''.join(NUCLEOTIDE_COMPLEMENTS.values()).encode('ascii'),
+)
+
+#
+# External programs that can decompress gzipped files to standard
+# output, in order of preference. They're much faster than Python's
+# gzip module, and pigz decompresses in a separate thread from the
+# one reading the file.
+#
+DECOMPRESSION_COMMANDS = (
+    ('pigz', '-dc'),
+    ('gzip', '-dc'),
+)
+
 
 class ExtendedFeature(object):
     """
@@ -126,19 +151,22 @@ def complement(seq):
     Return the complement of the supplied nucleic sequence.
 
     Nucleic of course implies that the only recognized bases are A, C,
-    G, T and N. Case will be preserved.
+    G, T and N. Case will be preserved, and any other characters are
+    left as they are.
 
     Parameters
     ----------
-    seq: str
+    seq: str or bytes
         A nucleic sequence.
 
     Returns
     -------
-    str
-        The complement of the given sequence.
+    str or bytes
+        The complement of the given sequence, of the same type.
     """
-    return ''.join(NUCLEOTIDE_COMPLEMENTS[base] for base in seq)
+    if isinstance(seq, bytes):
+        return seq.translate(NUCLEOTIDE_COMPLEMENT_BYTES_TABLE)
+    return seq.translate(NUCLEOTIDE_COMPLEMENT_TABLE)
 
 
 def reverse_complement(seq):
@@ -147,29 +175,70 @@ def reverse_complement(seq):
 
     Parameters
     ----------
-    seq: str
+    seq: str or bytes
         A nucleic sequence.
 
     Returns
     -------
-    str
-        The reverse complement of the given sequence.
+    str or bytes
+        The reverse complement of the given sequence, of the same type.
 
     See also
     --------
     :func:`~atactk.data.complement`
     """
-    return complement(reversed(seq))
+    return complement(seq)[::-1]
 
 
-def open_maybe_gzipped(filename):
+class DecompressionPipe(io.BufferedReader):
+    """
+    A binary stream reading the output of an external decompression program.
+
+    Closing the stream waits for the program to exit, and raises
+    :class:`IOError` if it failed. Wrap it in :class:`io.TextIOWrapper`
+    to read text.
+    """
+
+    def __init__(self, command, filename, buffer_size=1 << 20):
+        self.command = command
+        self.filename = filename
+        # -- so that a filename starting with - isn't taken for an option
+        self.process = subprocess.Popen(list(command) + ['--', filename], stdout=subprocess.PIPE, bufsize=0)
+        super(DecompressionPipe, self).__init__(self.process.stdout, buffer_size=buffer_size)
+
+    def close(self):
+        if self.closed:
+            return
+        super(DecompressionPipe, self).close()
+        returncode = self.process.wait()
+        if returncode > 0:
+            raise IOError('Could not decompress {}: {} exited with status {}'.format(self.filename, self.command[0], returncode))
+
+
+def find_decompression_command():
+    """
+    Return the first of the :data:`DECOMPRESSION_COMMANDS` installed, or None.
+    """
+    for command in DECOMPRESSION_COMMANDS:
+        if shutil.which(command[0]):
+            return command
+    return None
+
+
+def open_maybe_gzipped(filename, mode='rt'):
     """
     Open a possibly gzipped file.
 
+    Gzipped files are decompressed by an external program if one of
+    :data:`DECOMPRESSION_COMMANDS` is available, and by Python's
+    :mod:`gzip` module otherwise.
+
     Parameters
     ----------
     filename: str
         The name of the file to open.
+    mode: str
+        Either ``rt`` to read text, or ``rb`` to read bytes.
 
     Returns
     -------
@@ -179,17 +248,42 @@ def open_maybe_gzipped(filename):
     with open(filename, 'rb') as test_read:
         byte1, byte2 = ord(test_read.read(1)), ord(test_read.read(1))
         if byte1 == 0x1f and byte2 == 0x8b:
-            f = gzip.open(filename, mode='rt')
+            command = find_decompression_command()
+            if command:
+                f = DecompressionPipe(command, filename)
+                if mode != 'rb':
+                    f = io.TextIOWrapper(f)
+            else:
+                f = gzip.open(filename, mode=mode)
         else:
-            f = open(filename, 'rt')
+            f = open(filename, mode, 1 << 20)
     return f
 
 
 def count_features(filename):
+    """
+    Count the features in a possibly gzipped file of one feature per line.
+
+    The file is read in large binary chunks, and only the newlines are
+    counted, so no lines are decoded or split.
+
+    Parameters
+    ----------
+    filename: str
+        The name of the file.
+
+    Returns
+    -------
+    int
+        The number of lines in the file.
+    """
     count = 0
-    with open_maybe_gzipped(filename) as f:
-        for line in f:
-            count += 1
+    chunk = b''
+    with open_maybe_gzipped(filename, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+            count += chunk.count(b'\n')
+    if chunk and not chunk.endswith(b'\n'):
+        count += 1  # a last line without a newline
     return count
 
 
@@ -225,6 +319,64 @@ def read_features(filename, extension=100, feature_class=ExtendedFeature):
             yield feature_class(extension=extension, **row)
 
 
+def read_features_as_arrays(filename, extension=100):
+    """
+    Read the named tab-separated value file into arrays of feature attributes.
+
+    This reads the same fields as :func:`read_features`, but instead
+    of an object per feature, it returns a dict of
+    :class:`numpy.ndarray`, one per attribute, each indexed by the
+    feature's row in the file. For large feature sets, this takes far
+    less memory, and lets computations over all the features be
+    expressed as array operations.
+
+    Parameters
+    ----------
+    filename: str
+        The (optionally gzipped) tab-separated value file from which to read features. Use '-' to read from standard input.
+    extension: int
+        The number of bases to score on either side of each feature.
+
+    Returns
+    -------
+    dict
+        A dict of arrays named like the attributes of
+        :class:`ExtendedFeature`: ``reference``, ``feature_start``,
+        ``feature_end``, ``name``, ``score``, ``strand``, ``center``,
+        ``is_reverse``, ``region_start`` and ``region_end``. Scores
+        that :class:`ExtendedFeature` would record as None are NaN.
+    """
+
+    columns = dict((fieldname, []) for fieldname in FEATURE_FIELDNAMES)
+    with filename == '-' and sys.stdin or open_maybe_gzipped(filename) as source:
+        for row in csv.reader(source, dialect='excel-tab'):
+            if not row:
+                continue  # blank lines, which csv.DictReader skips for read_features
+            row = row + [''] * (len(FEATURE_FIELDNAMES) - len(row))
+            for fieldname, value in zip(FEATURE_FIELDNAMES, row):
+                columns[fieldname].append(value)
+
+    feature_start = np.array(columns['start'], dtype=np.int64)
+    feature_end = np.array(columns['end'], dtype=np.int64)
+    strand = np.array(columns['strand'])
+
+    # the same rounding as ExtendedFeature.center
+    center = feature_start + np.rint((feature_end - feature_start) / 2.0).astype(np.int64)
+
+    return {
+        'reference': np.array(columns['reference']),
+        'feature_start': feature_start,
+        'feature_end': feature_end,
+        'name': np.array(columns['name']),
+        'score': np.array([score and float(score) or np.nan for score in columns['score']], dtype=np.float64),
+        'strand': strand,
+        'center': center,
+        'is_reverse': strand == '-',
+        'region_start': center - extension,
+        'region_end': center + extension,
+    }
+
+
 def open_alignment_file(alignment_filename):
     alignment_file = pysam.AlignmentFile(alignment_filename, 'rb')
     try:
@@ -237,6 +389,57 @@ def open_alignment_file(alignment_filename):
     return alignment_file
 
 
+# alignment files opened by get_alignment_file, keyed by name and process
+# ID; a plain dict rather than functools.lru_cache, so entries can be
+# evicted by process and closed explicitly
+alignment_files = {}
+
+
+def get_alignment_file(alignment_file):
+    """
+    Return an open alignment file, opening it if necessary.
+
+    Named files are opened once per process and reused on subsequent
+    calls. The process ID is part of the cache key, so a worker forked
+    from a process that had already opened the file gets its own
+    handle instead of sharing the parent's. Handles inherited that way
+    are dropped from the cache the first time the worker calls this.
+
+    The handles are not closed or evicted otherwise: they stay open
+    until the process exits, or until :func:`close_alignment_files` is
+    called.
+
+    Parameters
+    ----------
+    alignment_file: str or :class:`pysam.AlignmentFile`
+        The name of an indexed BAM file, or an already opened one, which is returned as is.
+
+    Returns
+    -------
+    :class:`pysam.AlignmentFile`
+        The open alignment file.
+    """
+    if isinstance(alignment_file, pysam.AlignmentFile):
+        return alignment_file
+
+    pid = os.getpid()
+    key = (alignment_file, pid)
+    if key not in alignment_files:
+        for inherited_key in [k for k in alignment_files if k[1] != pid]:
+            del alignment_files[inherited_key]
+        alignment_files[key] = open_alignment_file(alignment_file)
+    return alignment_files[key]
+
+
+def close_alignment_files():
+    """
+    Close the alignment files this process opened with :func:`get_alignment_file`.
+    """
+    pid = os.getpid()
+    for key in [k for k in alignment_files if k[1] == pid]:
+        alignment_files.pop(key).close()
+
+
 def filter_aligned_segments(aligned_segments, include_flags, exclude_flags, quality):
     """
     Filter aligned segments using SAM flags and mapping quality.
@@ -295,20 +498,98 @@ def filter_aligned_segments(aligned_segments, include_flags, exclude_flags, qual
        - 128: second in pair
     """
 
-    filtered_aligned_segments = [a for a in aligned_segments if all([
-        a.mapping_quality >= quality,
-        any(map(lambda f: (a.flag & f) == f, include_flags)),
-        all(map(lambda f: (a.flag & f) == 0, exclude_flags))
-    ])]
+    aligned_segments = list(aligned_segments)
+    flags = np.fromiter((a.flag for a in aligned_segments), dtype=np.int64, count=len(aligned_segments))
+    mapping_qualities = np.fromiter((a.mapping_quality for a in aligned_segments), dtype=np.int64, count=len(aligned_segments))
+
+    keep = make_aligned_segment_filter_mask(flags, mapping_qualities, include_flags, exclude_flags, quality)
+    filtered_aligned_segments = [aligned_segments[i] for i in np.flatnonzero(keep)]
     return filtered_aligned_segments
 
 
+def make_aligned_segment_filter_mask(flags, mapping_qualities, include_flags, exclude_flags, quality):
+    """
+    Select aligned segments by SAM flags and mapping quality.
+
+    This is the test applied by :func:`filter_aligned_segments`, for
+    aligned segments whose attributes have already been collected into
+    arrays.
+
+    Parameters
+    ----------
+    flags: :class:`numpy.ndarray`
+        The SAM flags of each aligned segment.
+    mapping_qualities: :class:`numpy.ndarray`
+        The mapping quality of each aligned segment.
+    include_flags: list
+        Reads matching any include flag will be selected.
+    exclude_flags: list
+        Reads matching any exclude flag will not be selected.
+    quality: int
+        Only reads with at least this mapping quality will be selected.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        A boolean array that is true for each aligned segment meeting the criteria.
+    """
+    return (mapping_qualities >= quality) & make_flag_filter_table(include_flags, exclude_flags)[flags]
+
+
+# tables made by make_flag_filter_table, keyed by include and exclude flags
+flag_filter_tables = {}
+
+
+def make_flag_filter_table(include_flags, exclude_flags):
+    """
+    Return a table of which SAM flags pass the given include and exclude flags.
+
+    The table is computed once for each combination of flags, after
+    which deciding whether any number of aligned segments' flags pass
+    is a single lookup.
+
+    The exclude flags can be combined into one mask, but the include
+    flags can't: a read passes if it has all the bits of any one of
+    them, not all the bits of all of them. The table handles both
+    cases with the same lookup.
+
+    Parameters
+    ----------
+    include_flags: list
+        Flags matching any include flag will pass.
+    exclude_flags: list
+        Flags matching any exclude flag will not pass.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        A boolean array, indexed by flag, for every possible 16-bit SAM flag.
+    """
+    key = (tuple(include_flags), tuple(exclude_flags))
+    if key not in flag_filter_tables:
+        flags = np.arange(1 << 16)
+
+        # a read has none of the exclude flags if it has none of their bits
+        exclude_mask = functools.reduce(operator.or_, exclude_flags, 0)
+
+        table = np.zeros(len(flags), dtype=np.bool_)
+        for include_flag in include_flags:
+            table |= (flags & include_flag) == include_flag
+        table &= (flags & exclude_mask) == 0
+        flag_filter_tables[key] = table
+    return flag_filter_tables[key]
+
+
 def make_fastq_pair_reader(fastq_file1, fastq_file2):
     """
     Return a generator producing pairs of records from two FASTQ files.
 
     The intent is to produce read pairs from paired-end sequence data.
 
+    The files are read as bytes, in large buffered chunks, and the
+    records are returned as bytes, which is what most sequence work
+    wants anyway, without the cost of decoding every line.
+
     Parameters
     ----------
     fastq_file1: str
@@ -321,23 +602,16 @@ def make_fastq_pair_reader(fastq_file1, fastq_file2):
     ------
     tuple
         A tuple containing two 4-element lists, one for each FASTQ
-        record, representing the ID, sequence, comment, and quality lines.
+        record, representing the ID, sequence, comment, and quality
+        lines, as :class:`bytes` without line endings.
     """
 
-    f1 = open_maybe_gzipped(fastq_file1)
-    f2 = open_maybe_gzipped(fastq_file2)
-    while True:
-        yield (
-            [
-                next(f1).strip(),  # name
-                next(f1).strip(),  # sequence
-                next(f1).strip(),  # comment ('+' line)
-                next(f1).strip()   # quality
-            ],
-            [
-                next(f2).strip(),  # name
-                next(f2).strip(),  # sequence
-                next(f2).strip(),  # comment ('+' line)
-                next(f2).strip()   # quality
-            ],
-        )
+    with open_maybe_gzipped(fastq_file1, 'rb') as f1, open_maybe_gzipped(fastq_file2, 'rb') as f2:
+        # zipping four references to the same iterator groups its lines into records
+        records1 = zip(*[f1] * 4)
+        records2 = zip(*[f2] * 4)
+        for record1, record2 in zip(records1, records2):
+            yield (
+                [line.strip() for line in record1],
+                [line.strip() for line in record2],
+            )
@@ -7,12 +7,162 @@
 #
 
 
+import collections
+
+import numpy as np
+
+try:
+    import atactk._bamscan as _bamscan
+except ImportError:
+    _bamscan = None
+
 import atactk.data
 import atactk.util
 
 
 DEFAULT_CUT_POINT_OFFSET = 4
 
+# the number of features sent to a scoring process at a time, when the number of features isn't known in advance
+DEFAULT_SCORING_CHUNK_SIZE = 64
+
+
+CompiledBinGroups = collections.namedtuple('CompiledBinGroups', ['groups', 'keys', 'bins', 'group_indices', 'maximum_length'])
+
+
+def compile_bin_groups(bin_groups):
+    """
+    Prepare fragment size bin groups for scoring many features.
+
+    Everything the scoring functions need to know about the bin
+    groups, apart from the feature being scored, is computed here, so
+    it can be done once per run instead of once per feature.
+
+    Parameters
+    ----------
+    bin_groups: iterable
+        A sequence of iterables containing fragment size bins and the resolution with which they should be scored, as
+        returned by :func:`atactk.command.parse_bins`. Already compiled bin groups are returned unchanged.
+
+    Returns
+    -------
+    CompiledBinGroups
+        A named tuple of `(groups, keys, bins, group_indices, maximum_length)` where
+
+        * `groups` is a list of the bin groups, each a list of `(minimum_length, maximum_length, resolution)` tuples
+        * `keys` is a list of the key of each group, from :func:`atactk.util.make_bin_group_key`
+        * `bins` is a :class:`numpy.ndarray` of shape `(n, 3)` holding all the bins, in order
+        * `group_indices` is a :class:`numpy.ndarray` holding the index in `groups` of each of the `bins`
+        * `maximum_length` is the largest maximum fragment length of any of the bins, or zero if there are none
+    """
+    if isinstance(bin_groups, CompiledBinGroups):
+        return bin_groups
+
+    groups = [list(group) for group in bin_groups or []]
+    bins = np.array([bin for group in groups for bin in group], dtype=np.int64).reshape(-1, 3)
+    return CompiledBinGroups(
+        groups=groups,
+        keys=[atactk.util.make_bin_group_key(group) for group in groups],
+        bins=bins,
+        group_indices=np.array([g for g, group in enumerate(groups) for bin in group], dtype=np.int64),
+        maximum_length=int(bins[:, 1].max()) if len(bins) else 0,
+    )
+
+
+def extract_segment_arrays(aligned_segments):
+    """
+    Collect the attributes of aligned segments needed for scoring into arrays.
+
+    Each attribute is read from all the segments in one pass with
+    :func:`numpy.fromiter`, which is quicker than appending all of them
+    to lists in a single loop over the segments.
+
+    Parameters
+    ----------
+    aligned_segments: list
+        A list of :class:`pysam.AlignedSegment`.
+
+    Returns
+    -------
+    tuple
+        A tuple of :class:`numpy.ndarray` of `(reference_starts, reference_ends, fragment_lengths, is_reverse)`, each
+        with one element per aligned segment. Fragment lengths are signed, as in the BAM file.
+
+        Segments that are unmapped or have an empty CIGAR have no
+        reference end. As in htslib's ``bam_endpos``, which the
+        :mod:`atactk._bamscan` extension uses, theirs is taken to be
+        one past their start.
+    """
+    count = len(aligned_segments)
+    reference_starts = np.fromiter((s.reference_start for s in aligned_segments), dtype=np.int64, count=count)
+    reference_ends = np.fromiter(
+        (s.reference_start + 1 if (end := s.reference_end) is None else end for s in aligned_segments), dtype=np.int64, count=count
+    )
+    fragment_lengths = np.fromiter((s.isize for s in aligned_segments), dtype=np.int64, count=count)
+    is_reverse = np.fromiter((s.is_reverse for s in aligned_segments), dtype=np.bool_, count=count)
+    return reference_starts, reference_ends, fragment_lengths, is_reverse
+
+
+def fetch_segment_arrays(alignment_file, reference, start, end, include_flags, exclude_flags, quality):
+    """
+    Fetch and filter the aligned segments in a region, collecting the attributes needed for scoring into arrays.
+
+    This is :func:`atactk.data.filter_aligned_segments` followed by
+    :func:`extract_segment_arrays`. If the :mod:`atactk._bamscan`
+    extension was built when ``atactk`` was installed, it reads the
+    alignments through pysam's C API instead, without creating a
+    :class:`pysam.AlignedSegment` for each of them.
+
+    Parameters
+    ----------
+    alignment_file: :class:`pysam.AlignmentFile`
+        The indexed BAM file to read.
+    reference: str
+        The name of the reference sequence of the region.
+    start: int
+        The start of the region.
+    end: int
+        The end of the region.
+    include_flags: iterable
+        The SAM flags to use when selecting aligned segments.
+    exclude_flags: iterable
+        The SAM flags to use when excluding aligned segments; any flag present on a read excludes it.
+    quality: int
+        The minimum mapping quality a read must have to be selected.
+
+    Returns
+    -------
+    tuple
+        A tuple of :class:`numpy.ndarray`, as returned by :func:`extract_segment_arrays`.
+    """
+    if _bamscan is not None:
+        flag_filter_table = atactk.data.make_flag_filter_table(include_flags, exclude_flags)
+        return _bamscan.fetch_segment_arrays(alignment_file, reference, start, end, flag_filter_table.view(np.uint8), quality)
+
+    aligned_segments = alignment_file.fetch(reference, start, end)
+    aligned_segments = atactk.data.filter_aligned_segments(aligned_segments, include_flags, exclude_flags, quality)
+    return extract_segment_arrays(aligned_segments)
+
+
+def tally_positions(positions, start, end):
+    """
+    Count the occurrences of each position in a region.
+
+    Parameters
+    ----------
+    positions: :class:`numpy.ndarray`
+        Integer positions, all of which must fall between `start` and `end`.
+    start: int
+        The start of the region of interest.
+    end: int
+        The end of the region of interest.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The count of `positions` at each position from `start` to `end`.
+    """
+    return np.bincount(positions - start, minlength=end - start)
+
 
 def reduce_scores(scores, resolution):
     """
@@ -30,7 +180,38 @@ def reduce_scores(scores, resolution):
     4           [6, 2]
     10          [8]
     ==========  ======
+
+    At resolutions above 1, the result is a :class:`numpy.ndarray`.
+    Multidimensional arrays are reduced along their last axis, so the
+    rows of a 2-D array are all reduced at once.
     """
     if resolution == 1:
         return scores
-    return [sum(chunk) for chunk in atactk.util.partition(resolution, scores)]
+    scores = np.asarray(scores)
+    return np.add.reduceat(scores, np.arange(0, scores.shape[-1], resolution), axis=-1)
+
+
+def find_scoring_chunk_size(features, parallel):
+    """
+    Decide how many features to send to each scoring process at a time.
+
+    Larger chunks mean fewer round trips between the processes. When
+    the number of features is known, it's split into about eight
+    chunks per process, so the work still evens out at the end.
+
+    Parameters
+    ----------
+    features: iterable
+        The features to be scored.
+    parallel: int
+        The number of scoring processes.
+
+    Returns
+    -------
+    int
+        The chunk size to pass to :meth:`multiprocessing.pool.Pool.imap`.
+    """
+    try:
+        return max(16, len(features) // (parallel * 8))
+    except TypeError:
+        return DEFAULT_SCORING_CHUNK_SIZE
@@ -11,14 +11,19 @@
 Code for making quantitative observations about ATAC-seq experiments.
 """
 
-import collections
 import functools
 import multiprocessing
 import signal
 
+import numpy as np
+
+try:
+    import atactk._cutmatrix as _cutmatrix
+except ImportError:
+    _cutmatrix = None
+
 import atactk.data
 import atactk.metrics.common as common
-import atactk.util
 
 
 def find_cut_point(aligned_segment, cut_point_offset=common.DEFAULT_CUT_POINT_OFFSET):
@@ -43,6 +48,147 @@ def find_cut_point(aligned_segment, cut_point_offset=common.DEFAULT_CUT_POINT_OF
     return cut_point
 
 
+def extract_segment_arrays(aligned_segments):
+    """
+    Collect the attributes of aligned segments needed for scoring into arrays.
+
+    Parameters
+    ----------
+    aligned_segments: list
+        A list of :class:`pysam.AlignedSegment`.
+
+    Returns
+    -------
+    tuple
+        A tuple of :class:`numpy.ndarray` of `(reference_starts, reference_ends, fragment_sizes, is_reverse)`, each with
+        one element per aligned segment. Fragment sizes are absolute values.
+
+    See Also
+    --------
+    atactk.metrics.common.extract_segment_arrays: Which collects the signed fragment lengths.
+    """
+    reference_starts, reference_ends, fragment_lengths, is_reverse = common.extract_segment_arrays(aligned_segments)
+    return reference_starts, reference_ends, np.abs(fragment_lengths), is_reverse
+
+
+def find_cut_points(reference_starts, reference_ends, is_reverse, cut_point_offset=common.DEFAULT_CUT_POINT_OFFSET):
+    """
+    Return the positions of the ATAC-seq cut points of many aligned segments.
+
+    This is :func:`find_cut_point` applied to the arrays returned by
+    :func:`extract_segment_arrays`.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The position of each aligned segment's cut point.
+    """
+    return np.where(is_reverse, reference_ends - (cut_point_offset + 1), reference_starts + cut_point_offset)
+
+
+def count_cut_points_in_bins(cut_points, fragment_sizes, is_reverse, bins, start, end, feature_is_reverse=False):
+    """
+    Count cut points at each position in a region, for each fragment size bin and strand.
+
+    If the :mod:`atactk._cutmatrix` extension was built when
+    ``atactk`` was installed, it does the counting. Failing that, if
+    `numba` is installed, a kernel compiled with it on first use is used;
+    otherwise each bin is counted with NumPy.
+
+    Parameters
+    ----------
+    cut_points: :class:`numpy.ndarray`
+        Cut point positions. Any that don't fall between `start` and `end` are ignored.
+    fragment_sizes: :class:`numpy.ndarray`
+        The absolute fragment size of each cut point's aligned segment.
+    is_reverse: :class:`numpy.ndarray`
+        Whether each cut point's aligned segment is on the reverse strand.
+    bins: :class:`numpy.ndarray`
+        An array of shape `(n, 3)` holding the `(minimum_length, maximum_length, resolution)` of each bin.
+    start: int
+        The start of the region of interest.
+    end: int
+        The end of the region of interest.
+    feature_is_reverse: bool
+        If true, orient the counts to a feature on the reverse strand:
+        positions are reversed, and the strands swapped.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        An array of shape `(n, 2, end - start)` holding, for each bin,
+        the forward and reverse cut point counts at each position.
+    """
+    cut_points, fragment_sizes, is_reverse = np.asarray(cut_points), np.asarray(fragment_sizes), np.asarray(is_reverse)
+
+    # the compiled backends don't check their writes, so every backend gets only the cut points in the region
+    in_region = (start <= cut_points) & (cut_points < end)
+    if not in_region.all():
+        cut_points, fragment_sizes, is_reverse = cut_points[in_region], fragment_sizes[in_region], is_reverse[in_region]
+
+    if _cutmatrix is not None:
+        return _cutmatrix.count_cut_points_in_bins(
+            np.ascontiguousarray(cut_points, dtype=np.int64),
+            np.ascontiguousarray(fragment_sizes, dtype=np.int64),
+            np.ascontiguousarray(is_reverse, dtype=np.bool_).view(np.uint8),
+            np.ascontiguousarray(bins, dtype=np.int64),
+            start,
+            end,
+            feature_is_reverse,
+        )
+
+    kernel = _get_count_cut_points_in_bins_kernel()
+    if kernel is not None:
+        return kernel(cut_points, fragment_sizes, is_reverse, bins, start, end, feature_is_reverse)
+
+    counts = np.zeros((len(bins), 2, end - start), dtype=np.int64)
+    is_forward = ~is_reverse
+    for b, (minimum_length, maximum_length, resolution) in enumerate(bins):
+        in_bin = (minimum_length <= fragment_sizes) & (fragment_sizes <= maximum_length)
+        counts[b, 0] = common.tally_positions(cut_points[in_bin & is_forward], start, end)
+        counts[b, 1] = common.tally_positions(cut_points[in_bin & is_reverse], start, end)
+
+    if feature_is_reverse:
+        counts = counts[:, ::-1, ::-1]
+    return counts
+
+
+def _count_cut_points_in_bins_loop(cut_points, fragment_sizes, is_reverse, bins, start, end, feature_is_reverse):
+    length = end - start
+    counts = np.zeros((bins.shape[0], 2, length), dtype=np.int64)
+    for b in range(bins.shape[0]):
+        minimum_length = bins[b, 0]
+        maximum_length = bins[b, 1]
+        for i in range(cut_points.shape[0]):
+            position = cut_points[i] - start
+            # numba doesn't check bounds, so positions outside the region are skipped here, as in _cutmatrix
+            if position < 0 or position >= length:
+                continue
+            if minimum_length <= fragment_sizes[i] <= maximum_length:
+                strand = 1 if is_reverse[i] else 0
+                if feature_is_reverse:
+                    strand = 1 - strand
+                    position = length - 1 - position
+                counts[b, strand, position] += 1
+    return counts
+
+
+@functools.lru_cache(maxsize=None)
+def _get_count_cut_points_in_bins_kernel():
+    """
+    Return :func:`_count_cut_points_in_bins_loop` compiled with numba, or None if numba isn't installed.
+
+    Importing numba takes a good fraction of a second, so it's only
+    done the first time the kernel is needed, which is never when the
+    :mod:`atactk._cutmatrix` extension has been built.
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(cache=True)(_count_cut_points_in_bins_loop)
+
+
 def count_cut_points(aligned_segments, start, end, cut_point_offset=common.DEFAULT_CUT_POINT_OFFSET):
     """
     Return any cut points in the region from the aligned segments.
@@ -63,20 +209,10 @@ def count_cut_points(aligned_segments, start, end, cut_point_offset=common.DEFAU
         of the aligned segments' cut points at that position.
     """
 
-    cut_points_in_region = []
-    for segment in aligned_segments:
-        cut_point = find_cut_point(segment, cut_point_offset)
-        if start <= cut_point < end:
-            cut_points_in_region.append(cut_point)
-
-    # initialize the region with zero counts
-    counts = {p: 0 for p in range(start, end)}
-
-    # add the cut points
-    counts.update(collections.Counter(cut_points_in_region))
-
-    cut_point_counts = [counts[position] for position in sorted(counts.keys())]
-    return cut_point_counts
+    reference_starts, reference_ends, fragment_sizes, is_reverse = extract_segment_arrays(aligned_segments)
+    cut_points = find_cut_points(reference_starts, reference_ends, is_reverse, cut_point_offset)
+    cut_points_in_region = cut_points[(start <= cut_points) & (cut_points < end)]
+    return common.tally_positions(cut_points_in_region, start, end).tolist()
 
 
 def add_cut_points_to_region_tree(region_tree, group_key, strand, cut_points):
@@ -108,21 +244,21 @@ def add_cut_points_to_region_tree(region_tree, group_key, strand, cut_points):
     space to record so many zeroes, and it's better to produce them on
     demand via :class:`collections.defaultdict`. So instead, collect
     all the scores, and after that work is done, update a tree built
-    with :class:`collections.defaultdict`, then work with that. See
-    the ``make_cut_matrix`` script included with ``atactk`` for an
-    example.
-    """
-
-    for position, count in enumerate(cut_points, 0 - (len(cut_points) // 2)):
-        if count > 0:
-            if position not in region_tree:
-                region_tree[position] = {}
-            if group_key not in region_tree[position]:
-                region_tree[position][group_key] = {}
-            if strand not in region_tree[position][group_key]:
-                region_tree[position][group_key][strand] = count
-            else:
-                region_tree[position][group_key][strand] += count
+    with :class:`collections.defaultdict`, then work with that.
+
+    Scoring doesn't use this tree: :func:`score_feature_with_cut_points`
+    returns its counts as a :class:`numpy.ndarray` of shape `(groups,
+    strands, positions)`, which is what worker processes send back and
+    what is summed for an aggregate matrix. This function remains for
+    code that works with the tree of dictionaries.
+    """
+
+    cut_points = np.asarray(cut_points)
+    nonzero = np.flatnonzero(cut_points > 0)
+    positions = (nonzero - (len(cut_points) // 2)).tolist()
+    for position, count in zip(positions, cut_points[nonzero].tolist()):
+        strand_counts = region_tree.setdefault(position, {}).setdefault(group_key, {})
+        strand_counts[strand] = strand_counts.get(strand, 0) + count
 
 
 def score_feature_with_cut_points(bin_groups, include_flags, exclude_flags, quality, cut_point_offset, feature):
@@ -139,7 +275,8 @@ def score_feature_with_cut_points(bin_groups, include_flags, exclude_flags, qual
     bin_groups: iterable
         A sequence of iterables containing fragment size bins and the resolution with which they should be scored. If
         omitted, the matrix will contain a column for each position in the extended region, representing the count of
-        cuts at that position.
+        cuts at that position. When scoring many features, pass the result of
+        :func:`atactk.metrics.common.compile_bin_groups` to avoid preparing the bins for each one.
     include_flags: iterable
         The SAM flags to use when selecting aligned segments to score.
     exclude_flags: iterable
@@ -152,72 +289,69 @@ def score_feature_with_cut_points(bin_groups, include_flags, exclude_flags, qual
     Returns
     -------
     tuple
-        A tuple of `(row, tree)` where
+        A tuple of `(feature, row, tree)` where
 
+        * `feature` is the feature scored
         * `row` is a tab-separated list of scores in the region around the feature
-        * `tree` is a three-level dict holding a score for each position, in each of the fragment size bins given, on each strand, e.g.::
+        * `tree` is a :class:`numpy.ndarray` of shape `(groups, strands, positions)` holding the cut point count at each
+          position in the region, for each of the fragment size bin groups given, on each strand. The strands are
+          forward and reverse, oriented to the feature. Without `bin_groups`, there is a single group and strand
+          holding the count of all cut points. Positions are relative to the start of the region, so the feature's
+          center is at index `feature.extension`, e.g.::
 
-            >>> tree[0]['36_149']['F']
+            >>> tree[0, 0, feature.extension]  # first bin group, forward strand, feature center
             22
-            >>> tree[0]['36_149']['R']
+            >>> tree[0, 1, feature.extension]  # first bin group, reverse strand, feature center
             15
 
-
-    See Also
-    --------
-    add_cut_points_to_region_tree: Where the tree for the cut point aggregate matrix is described more fully.
+          The trees for many features can be summed to produce an aggregate matrix.
     """
 
-    aligned_segments = alignment_file.fetch(feature.reference, max(0, feature.region_start), feature.region_end)
-    aligned_segments = atactk.data.filter_aligned_segments(aligned_segments, include_flags, exclude_flags, quality)
-
-    row = []
-    tree = {}
-
-    if bin_groups:
-        for group in bin_groups:
-            group_rows = []
-            group_key = atactk.util.make_bin_group_key(group)
-            for (minimum_length, maximum_length, resolution) in group:
-                bin_scores = []
-                aligned_segments_in_bin = [a for a in aligned_segments if minimum_length <= abs(a.isize) <= maximum_length]
-                forward_aligned_segments = [a for a in aligned_segments_in_bin if not a.is_reverse]
-                reverse_aligned_segments = [a for a in aligned_segments_in_bin if a.is_reverse]
-
-                forward_cut_points = count_cut_points(forward_aligned_segments, feature.region_start, feature.region_end, cut_point_offset)
-                reverse_cut_points = count_cut_points(reverse_aligned_segments, feature.region_start, feature.region_end, cut_point_offset)
+    bin_groups = common.compile_bin_groups(bin_groups)
 
-                if feature.is_reverse:
-                    # need to orient the cut point positions to the motif in the matrix
-                    forward_cut_points, reverse_cut_points = list(reversed(reverse_cut_points)), list(reversed(forward_cut_points))
-
-                # for the discrete matrix: scores for each feature
-                bin_scores.extend(common.reduce_scores(forward_cut_points, resolution))
-                bin_scores.extend(common.reduce_scores(reverse_cut_points, resolution))
-                group_rows.append(bin_scores)
-
-                # for the aggregate matrix: scores for the entire region
-                add_cut_points_to_region_tree(tree, group_key, 'F', forward_cut_points)
-                add_cut_points_to_region_tree(tree, group_key, 'R', reverse_cut_points)
-
-            if len(group) == 1:
-                row.extend(group_rows[0])
-            else:
-                row.extend(functools.reduce(atactk.util.add_lists, group_rows))
+    reference_starts, reference_ends, fragment_lengths, is_reverse = common.fetch_segment_arrays(
+        alignment_file, feature.reference, max(0, feature.region_start), feature.region_end, include_flags, exclude_flags, quality
+    )
+    fragment_sizes = np.abs(fragment_lengths)
+    cut_points = find_cut_points(reference_starts, reference_ends, is_reverse, cut_point_offset)
+
+    # only cut points in the region can be scored
+    in_region = (feature.region_start <= cut_points) & (cut_points < feature.region_end)
+    cut_points, fragment_sizes, is_reverse = cut_points[in_region], fragment_sizes[in_region], is_reverse[in_region]
+
+    if bin_groups.groups:
+        bin_counts = count_cut_points_in_bins(
+            cut_points, fragment_sizes, is_reverse, bin_groups.bins, feature.region_start, feature.region_end, feature.is_reverse
+        )
+
+        # for the aggregate matrix: scores for the entire region, summed over the bins in each group
+        tree = np.zeros((len(bin_groups.groups), 2, feature.region_length), dtype=np.int64)
+        np.add.at(tree, bin_groups.group_indices, bin_counts)
+
+        # for the discrete matrix: scores for each feature, forward strand then reverse; the bins in a group share its
+        # resolution, so the group's summed counts in the tree can be reduced in one pass instead of reducing each bin
+        row_parts = []
+        for group, group_counts in zip(bin_groups.groups, tree):
+            resolution = group[0][2]
+            row_parts.append(common.reduce_scores(group_counts, resolution).ravel())
+        row = np.concatenate(row_parts)
     else:
-        row = count_cut_points(aligned_segments, feature.region_start, feature.region_end, cut_point_offset)
+        cut_point_counts = common.tally_positions(cut_points, feature.region_start, feature.region_end)
         if feature.is_reverse:
-            row = list(reversed(row))
-        add_cut_points_to_region_tree(tree, 'All', 'Both', row)
+            cut_point_counts = cut_point_counts[::-1]
+        row = cut_point_counts
+        tree = cut_point_counts.reshape(1, 1, -1)
 
-    row = '\t'.join(str(score) for score in row)
+    # format the whole row from one list of Python ints rather than element by element
+    row = '\t'.join(map(str, row.tolist()))
     return feature, row, tree
 
 
 alignment_file = None
+scoring_arguments = ()
 
 
-def scoring_process_init(alignment_filename):
+def scoring_process_init(alignment_filename, *arguments):
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     global alignment_file
@@ -225,18 +359,140 @@ def scoring_process_init(alignment_filename):
         alignment_file.close()
     alignment_file = atactk.data.open_alignment_file(alignment_filename)
 
+    # the scoring arguments are the same for every feature, so each worker keeps its own copy instead of receiving them
+    # with every batch of features
+    global scoring_arguments
+    scoring_arguments = arguments
+
+
+def score_feature_in_process(feature):
+    """
+    Score a feature with the arguments given to :func:`scoring_process_init`.
+    """
+    return score_feature_with_cut_points(*scoring_arguments, feature)
+
 
 def score_features_with_cut_points(alignment_file, bin_groups, include_flags, exclude_flags, quality, cut_point_offset, features, parallel=1):
+    """
+    Score features with :func:`score_feature_with_cut_points`, in parallel.
 
-    partial_scoring_function = functools.partial(
-        score_feature_with_cut_points,
-        bin_groups,
-        include_flags,
-        exclude_flags,
-        quality,
-        cut_point_offset
-    )
+    The worker processes are cleaned up when the results have all been
+    consumed. If the generator is interrupted, e.g. by a
+    KeyboardInterrupt, or closed early, they are terminated.
 
-    pool = multiprocessing.Pool(processes=parallel, initializer=scoring_process_init, initargs=[alignment_file])
+    Yields
+    ------
+    tuple
+        The `(feature, row, tree)` of each feature, in the order of `features`.
+    """
+
+    initargs = [alignment_file, common.compile_bin_groups(bin_groups), include_flags, exclude_flags, quality, cut_point_offset]
+    pool = multiprocessing.Pool(processes=parallel, initializer=scoring_process_init, initargs=initargs)
+    try:
+        # imap rather than imap_unordered, so the rows of a discrete matrix stay in the order of the features
+        for scored_feature in pool.imap(score_feature_in_process, features, common.find_scoring_chunk_size(features, parallel)):
+            yield scored_feature
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def aggregate_cut_points(bin_groups, include_flags, exclude_flags, quality, cut_point_offset, features):
+    """
+    Sum the cut point trees of a sequence of features.
+
+    Like :func:`score_feature_with_cut_points`, this expects the
+    global `atactk.metrics.cut.alignment_file` to have been opened by
+    :func:`scoring_process_init`.
 
-    return pool.imap(partial_scoring_function, features, parallel)
+    Returns
+    -------
+    tuple
+        A tuple of `(count, tree)`, where `count` is the number of features scored, and `tree` the sum of their
+        trees, or None if there were no features.
+    """
+    count = 0
+    tree = None
+    for count, feature in enumerate(features, 1):
+        feature, row, feature_tree = score_feature_with_cut_points(bin_groups, include_flags, exclude_flags, quality, cut_point_offset, feature)
+        if tree is None:
+            tree = np.array(feature_tree)
+        else:
+            tree += feature_tree
+    return count, tree
+
+
+def aggregate_cut_points_in_process(features):
+    """
+    Sum the cut point trees of features with the arguments given to :func:`scoring_process_init`.
+    """
+    return aggregate_cut_points(*scoring_arguments, features)
+
+
+def shard_features(features, shard_size=1000):
+    """
+    Split features into shards of nearby features for parallel scoring.
+
+    Features are sorted by reference and position, then each
+    reference's features are split into shards of at most
+    `shard_size`, so each worker reads from one part of the BAM file
+    at a time, while a large reference can still be spread over many
+    workers.
+
+    Returns
+    -------
+    list
+        A list of lists of features.
+    """
+    shards = []
+    shard = []
+    for feature in sorted(features, key=lambda f: (f.reference, f.region_start)):
+        if shard and (len(shard) == shard_size or shard[-1].reference != feature.reference):
+            shards.append(shard)
+            shard = []
+        shard.append(feature)
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def aggregate_features_with_cut_points(alignment_file, bin_groups, include_flags, exclude_flags, quality, cut_point_offset, features, parallel=1):
+    """
+    Sum the cut point trees of all the features, scoring them in parallel.
+
+    Instead of returning every feature's row and tree, as
+    :func:`score_features_with_cut_points` does, each worker process
+    sums the trees of a shard of nearby features (see
+    :func:`shard_features`), and only those sums are returned and
+    added together. Use this when only the aggregate matrix is needed.
+
+    Returns
+    -------
+    tuple
+        A tuple of `(count, tree)`, where `count` is the number of features scored, and `tree` the sum of their
+        trees, as described in :func:`score_feature_with_cut_points`, or None if there were no features.
+    """
+
+    count = 0
+    tree = None
+
+    initargs = [alignment_file, common.compile_bin_groups(bin_groups), include_flags, exclude_flags, quality, cut_point_offset]
+    pool = multiprocessing.Pool(processes=parallel, initializer=scoring_process_init, initargs=initargs)
+    try:
+        for shard_count, shard_tree in pool.imap_unordered(aggregate_cut_points_in_process, shard_features(features)):
+            count += shard_count
+            if tree is None:
+                tree = shard_tree
+            else:
+                tree += shard_tree
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return count, tree
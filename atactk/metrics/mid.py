@@ -11,14 +11,13 @@
 Code for making quantitative observations about ATAC-seq experiments.
 """
 
-import collections
-import functools
 import multiprocessing
 import signal
 
+import numpy as np
+
 import atactk.data
 import atactk.metrics.common as common
-import atactk.util
 
 
 #
@@ -54,6 +53,48 @@ def find_midpoint(aligned_segment):
         return aligned_segment.reference_start + (aligned_segment.isize // 2)
 
 
+def select_fragment_segments(aligned_segments):
+    """
+    Return one aligned segment for each fragment, the first seen of its mates.
+
+    Parameters
+    ----------
+    aligned_segments: list
+        A list of :class:`pysam.AlignedSegment`.
+
+    Returns
+    -------
+    list
+        The aligned segments whose mates have not already been seen.
+    """
+    reads_seen = set()  # names of reads already seen, to avoid double-counting fragments
+    fragment_segments = []
+    for segment in aligned_segments:
+        query_name = segment.query_name
+        if query_name in reads_seen:
+            # skip this one; we've already found the midpoint of its fragment using its mate
+            continue
+
+        reads_seen.add(query_name)
+        fragment_segments.append(segment)
+    return fragment_segments
+
+
+def find_midpoints(reference_starts, reference_ends, fragment_lengths, is_reverse):
+    """
+    Return the locations of the midpoints of many aligned segments.
+
+    This is :func:`find_midpoint` applied to the arrays returned by
+    :func:`atactk.metrics.common.extract_segment_arrays`.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The integer position of each segment's midpoint.
+    """
+    return np.where(is_reverse, reference_ends, reference_starts) + (fragment_lengths // 2)
+
+
 def count_midpoints(aligned_segments, feature):
     """
     Count the aligned segments' midpoints that fall in the feature's extended region.
@@ -76,29 +117,13 @@ def count_midpoints(aligned_segments, feature):
         of fragment midpoints at that position relative to the feature.
     """
 
-    reads_seen = {}  # map of read names already seen, to avoid double-counting fragments
-    midpoints_in_region = []
-    for segment in aligned_segments:
-        if segment.qname in reads_seen:
-            # skip this one; we've already found the midpoint of its fragment using its mate
-            continue
-
-        reads_seen[segment.qname] = 1
-
-        midpoint = find_midpoint(segment)
-        if feature.region_start <= midpoint < feature.region_end:
-            midpoints_in_region.append(midpoint)
-
-    # initialize the region with zero counts
-    counts = {p: 0 for p in range(feature.region_start, feature.region_end)}
-
-    # add the cut points
-    counts.update(collections.Counter(midpoints_in_region))
-
-    midpoint_counts = [counts[position] for position in sorted(counts.keys())]
+    reference_starts, reference_ends, fragment_lengths, is_reverse = common.extract_segment_arrays(select_fragment_segments(aligned_segments))
+    midpoints = find_midpoints(reference_starts, reference_ends, fragment_lengths, is_reverse)
+    midpoints_in_region = midpoints[(feature.region_start <= midpoints) & (midpoints < feature.region_end)]
+    midpoint_counts = common.tally_positions(midpoints_in_region, feature.region_start, feature.region_end)
     if feature.is_reverse:
-        midpoint_counts = list(reversed(midpoint_counts))
-    return midpoint_counts
+        midpoint_counts = midpoint_counts[::-1]
+    return midpoint_counts.tolist()
 
 
 def add_midpoints_to_region_tree(region_tree, group_key, midpoints):
@@ -127,19 +152,15 @@ def add_midpoints_to_region_tree(region_tree, group_key, midpoints):
     space to record so many zeroes, and it's better to produce them on
     demand via :class:`collections.defaultdict`. So instead, collect
     all the scores, and after that work is done, update a tree built
-    with :class:`collections.defaultdict`, then work with that. See
-    the ``make_cut_matrix`` script included with ``atactk`` for an
-    example.
+    with :class:`collections.defaultdict`, then work with that.
     """
 
-    for position, count in enumerate(midpoints, 0 - (len(midpoints) // 2)):
-        if count > 0:
-            if position not in region_tree:
-                region_tree[position] = {}
-            if group_key not in region_tree[position]:
-                region_tree[position][group_key] = count
-            else:
-                region_tree[position][group_key] += count
+    midpoints = np.asarray(midpoints)
+    nonzero = np.flatnonzero(midpoints > 0)
+    positions = (nonzero - (len(midpoints) // 2)).tolist()
+    for position, count in zip(positions, midpoints[nonzero].tolist()):
+        group_counts = region_tree.setdefault(position, {})
+        group_counts[group_key] = group_counts.get(group_key, 0) + count
 
 
 def score_feature_with_midpoints(bin_groups, include_flags, exclude_flags, quality, feature):
@@ -154,7 +175,9 @@ def score_feature_with_midpoints(bin_groups, include_flags, exclude_flags, quali
     Parameters
     ----------
     bin_groups: iterable
-        A sequence of iterables containing bins and the resolution with which they should be scored.
+        A sequence of iterables containing bins and the resolution with which they should be scored: either as
+        returned by :func:`atactk.command.parse_bins`, or better when scoring many features, compiled with
+        :func:`atactk.metrics.common.compile_bin_groups`.
     include_flags: iterable
         The SAM flags to use when selecting aligned segments to score.
     exclude_flags: iterable
@@ -184,7 +207,9 @@ def score_feature_with_midpoints(bin_groups, include_flags, exclude_flags, quali
 
     """
 
-    alignment_search_region_extension = max([b[1] for bins in bin_groups for b in bins]) // 2
+    bin_groups = common.compile_bin_groups(bin_groups)
+
+    alignment_search_region_extension = bin_groups.maximum_length // 2
 
     aligned_segments = alignment_file.fetch(
         feature.reference,
@@ -193,37 +218,42 @@ def score_feature_with_midpoints(bin_groups, include_flags, exclude_flags, quali
     )
     aligned_segments = atactk.data.filter_aligned_segments(aligned_segments, include_flags, exclude_flags, quality)
 
-    row = []
+    # find each fragment's midpoint and size once, then select each bin's fragments from those
+    reference_starts, reference_ends, fragment_lengths, is_reverse = common.extract_segment_arrays(select_fragment_segments(aligned_segments))
+    midpoints = find_midpoints(reference_starts, reference_ends, fragment_lengths, is_reverse)
+    in_region = (feature.region_start <= midpoints) & (midpoints < feature.region_end)
+    midpoints = midpoints[in_region]
+    fragment_sizes = np.abs(fragment_lengths[in_region])
+
+    row_parts = []
     tree = {}
 
-    for group in bin_groups:
-        group_rows = []
-        group_key = atactk.util.make_bin_group_key(group)
+    for group, group_key in zip(bin_groups.groups, bin_groups.keys):
+        group_counts = np.zeros(feature.region_end - feature.region_start, dtype=np.int64)
         for (minimum_length, maximum_length, resolution) in group:
-            bin_scores = []
-            aligned_segments_in_bin = [a for a in aligned_segments if minimum_length <= abs(a.isize) <= maximum_length]
-            midpoint_counts = count_midpoints(aligned_segments_in_bin, feature)
-
-            # for the discrete matrix: scores for each feature
-            bin_scores.extend(common.reduce_scores(midpoint_counts, resolution))
-            group_rows.append(bin_scores)
+            in_bin = (minimum_length <= fragment_sizes) & (fragment_sizes <= maximum_length)
+            group_counts += common.tally_positions(midpoints[in_bin], feature.region_start, feature.region_end)
+        if feature.is_reverse:
+            group_counts = group_counts[::-1]
 
-            # for the aggregate matrix: scores for the entire region
-            add_midpoints_to_region_tree(tree, group_key, midpoint_counts)
+        # for the discrete matrix: scores for each feature; the bins in a group share its resolution, so their counts
+        # can be summed before they're reduced
+        row_parts.append(common.reduce_scores(group_counts, resolution))
 
-        if len(group) == 1:
-            row.extend(group_rows[0])
-        else:
-            row.extend(functools.reduce(atactk.util.add_lists, group_rows))
+        # for the aggregate matrix: scores for the entire region
+        add_midpoints_to_region_tree(tree, group_key, group_counts)
 
-    row = '\t'.join(str(score) for score in row)
+    # format the whole row from one list of Python ints rather than element by element
+    row = np.concatenate(row_parts) if row_parts else np.zeros(0, dtype=np.int64)
+    row = '\t'.join(map(str, row.tolist()))
     return feature, row, tree
 
 
 alignment_file = None
+scoring_arguments = ()
 
 
-def scoring_process_init(alignment_filename):
+def scoring_process_init(alignment_filename, *arguments):
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     global alignment_file
@@ -231,21 +261,45 @@ def scoring_process_init(alignment_filename):
         alignment_file.close()
     alignment_file = atactk.data.open_alignment_file(alignment_filename)
 
+    # the scoring arguments are the same for every feature, so each worker keeps its own copy instead of receiving them
+    # with every batch of features
+    global scoring_arguments
+    scoring_arguments = arguments
 
-def score_features_with_midpoints(alignment_file, bin_groups, include_flags, exclude_flags, quality, cut_point_offset, features, parallel=1):
 
-    partial_scoring_function = functools.partial(
-        score_feature_with_midpoints,
-        bin_groups,
-        include_flags,
-        exclude_flags,
-        quality,
-        cut_point_offset
-    )
+def score_feature_in_process(feature):
+    """
+    Score a feature with the arguments given to :func:`scoring_process_init`.
+    """
+    return score_feature_with_midpoints(*scoring_arguments, feature)
 
-    pool = multiprocessing.Pool(processes=parallel, initializer=scoring_process_init, initargs=[alignment_file])
 
-    return pool.imap(partial_scoring_function, features, parallel)
+def score_features_with_midpoints(alignment_file, bin_groups, include_flags, exclude_flags, quality, features, parallel=1):
+    """
+    Score features with :func:`score_feature_with_midpoints`, in parallel.
+
+    The worker processes are cleaned up when the results have all been
+    consumed. If the generator is interrupted, e.g. by a
+    KeyboardInterrupt, or closed early, they are terminated.
+
+    Yields
+    ------
+    tuple
+        The `(feature, row, tree)` of each feature, in the order of `features`.
+    """
+
+    initargs = [alignment_file, common.compile_bin_groups(bin_groups), include_flags, exclude_flags, quality]
+    pool = multiprocessing.Pool(processes=parallel, initializer=scoring_process_init, initargs=initargs)
+    try:
+        # imap rather than imap_unordered, so the rows of a discrete matrix stay in the order of the features
+        for scored_feature in pool.imap(score_feature_in_process, features, common.find_scoring_chunk_size(features, parallel)):
+            yield scored_feature
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 
 def get_fragment_cut_points(aligned_segment, cut_point_offset=common.DEFAULT_CUT_POINT_OFFSET):
@@ -311,14 +365,44 @@ def get_fragment_position_relative_to_feature(aligned_segment, cut_point_offset,
     return position
 
 
-def find_midpoints_around_feature(alignment_filename, include_flags, exclude_flags, quality, cut_point_offset, feature):
+def find_fragment_positions_relative_to_feature(reference_starts, reference_ends, fragment_lengths, is_reverse, next_reference_starts, cut_point_offset, feature):
+    """
+    Determine where many aligned segments' fragments map relative to a feature.
+
+    This is :func:`get_fragment_position_relative_to_feature` applied
+    to arrays of the segments' attributes, as returned by
+    :func:`atactk.metrics.common.extract_segment_arrays`, plus their
+    mates' reference starts.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The position of each fragment relative to the feature, one of :data:`FEATURE_RELATIVE_POSITIONS`.
+    """
+
+    # the cut points of each fragment, as in get_fragment_cut_points
+    left_cut_points = np.where(is_reverse, next_reference_starts, reference_starts) + cut_point_offset
+    right_cut_points = np.where(is_reverse, reference_ends, reference_starts + fragment_lengths) - (cut_point_offset + 1)
+
+    # indexes into FEATURE_RELATIVE_POSITIONS: 'left' of the feature, 'right' of it, or overlapping it
+    positions = np.ones(len(left_cut_points), dtype=np.int64)
+    positions[feature.center > np.maximum(left_cut_points, right_cut_points)] = 0
+    positions[feature.center < np.minimum(left_cut_points, right_cut_points)] = 2
+    if feature.is_reverse:
+        positions = 2 - positions
+
+    return np.array(FEATURE_RELATIVE_POSITIONS)[positions]
+
+
+def find_midpoints_around_feature(alignment_file, include_flags, exclude_flags, quality, cut_point_offset, feature):
     """
     Find fragment midpoints around a feature.
 
     Parameters
     ----------
-    alignment_filename: str
-        The BAM file containing aligned reads.
+    alignment_file: str or :class:`pysam.AlignmentFile`
+        The BAM file containing aligned reads. If given a filename, the
+        file is only opened on the first call in each process.
     include_flags: iterable
         The SAM flags to use when selecting aligned segments to score.
     exclude_flags: iterable
@@ -334,28 +418,37 @@ def find_midpoints_around_feature(alignment_filename, include_flags, exclude_fla
     fragment's position relative to the feature center.
     """
 
-    alignment_file = atactk.data.open_alignment_file(alignment_filename)
+    alignment_file = atactk.data.get_alignment_file(alignment_file)
 
     feature_center = feature.center
-    reads_seen = {}  # map of read names already seen, to avoid double-counting fragments
     midpoints = []
 
     aligned_segments = alignment_file.fetch(feature.reference, max(0, feature.region_start), feature.region_end)
     aligned_segments = atactk.data.filter_aligned_segments(aligned_segments, include_flags, exclude_flags, quality)
+    fragment_segments = select_fragment_segments(aligned_segments)
 
-    for aligned_segment in aligned_segments:
-        if aligned_segment.qname in reads_seen:
-            # skip this one; we've already found the midpoint of its fragment using its mate
-            continue
-
-        reads_seen[aligned_segment.qname] = 1
+    reference_starts, reference_ends, fragment_lengths, is_reverse = common.extract_segment_arrays(fragment_segments)
+    fragment_midpoints = find_midpoints(reference_starts, reference_ends, fragment_lengths, is_reverse)
+    in_region = np.flatnonzero((feature.region_start <= fragment_midpoints) & (fragment_midpoints <= feature.region_end))
+    midpoints_in_region = fragment_midpoints[in_region]
+    distances_to_center = midpoints_in_region - feature_center
+    if feature.is_reverse:
+        distances_to_center = -distances_to_center
+    fragment_sizes = np.abs(fragment_lengths[in_region])
+
+    next_reference_starts = np.fromiter((fragment_segments[i].next_reference_start for i in in_region.tolist()), dtype=np.int64, count=len(in_region))
+    fragment_relative_positions = find_fragment_positions_relative_to_feature(
+        reference_starts[in_region],
+        reference_ends[in_region],
+        fragment_lengths[in_region],
+        is_reverse[in_region],
+        next_reference_starts,
+        cut_point_offset,
+        feature
+    )
 
-        midpoint = find_midpoint(aligned_segment)
-        if feature.region_start <= midpoint <= feature.region_end:
-            distance_to_center = midpoint - feature_center
-            if feature.is_reverse:
-                distance_to_center *= -1
-            fragment_relative_position = get_fragment_position_relative_to_feature(aligned_segment, cut_point_offset, feature)
-            midpoints.append((feature_center, midpoint, distance_to_center, abs(aligned_segment.isize), fragment_relative_position))
+    for midpoint, distance_to_center, fragment_size, fragment_relative_position in zip(
+            midpoints_in_region.tolist(), distances_to_center.tolist(), fragment_sizes.tolist(), fragment_relative_positions.tolist()):
+        midpoints.append((feature_center, midpoint, distance_to_center, fragment_size, fragment_relative_position))
 
     return midpoints
@@ -10,35 +10,36 @@
 Utility code used in atactk.
 """
 
-import collections
+import itertools
 import logging
-import operator
 import os
 import resource
 import signal
 
+import numpy as np
+
 
 def add_lists(l1, l2):
     """
     Adds the values of two lists, entrywise.
 
     >>> add_lists([0, 1, 2], [3, 4, 5])
-    [3, 5, 7]
+    array([3, 5, 7])
 
     Parameters
     ----------
-    l1: list
+    l1: list or :class:`numpy.ndarray`
        The first list.
-    l2: list
+    l2: list or :class:`numpy.ndarray`
        The second list.
 
     Returns
     -------
-    sum: list
-        The list of the entrywise sums of the two lists' elements.
+    sum: :class:`numpy.ndarray`
+        The array of the entrywise sums of the two lists' elements.
 
     """
-    return map(operator.add, l1, l2)
+    return np.add(l1, l2)
 
 
 def exit_forcefully(signum, stack):
@@ -48,18 +49,14 @@ def exit_forcefully(signum, stack):
 
 def humanize_time(seconds):
     s = ''
-    days = hours = minutes = 0
     if seconds >= 86400:
-        days = seconds // 86400
-        seconds = seconds % 86400
+        days, seconds = divmod(seconds, 86400)
         s += '{:.0f}d '.format(days)
     if seconds >= 3600:
-        hours = seconds // 3600
-        seconds = seconds % 3600
+        hours, seconds = divmod(seconds, 3600)
         s += '{:.0f}h '.format(hours)
     if seconds >= 60:
-        minutes = seconds // 60
-        seconds = seconds % 60
+        minutes, seconds = divmod(seconds, 60)
         s += '{:.0f}m '.format(minutes)
     if not s:
         s += '{:.2f}s'.format(seconds)
@@ -102,15 +99,7 @@ def take(count, seq):
         A list of up to `count` elements. There may be fewer if `seq` has been exhausted.
 
     """
-    if not isinstance(seq, collections.Iterator):
-        seq = iter(seq)
-    l = []
-    try:
-        for i in range(count):
-            l.append(next(seq))
-    except StopIteration:
-        pass
-    return l
+    return list(itertools.islice(seq, count))
 
 
 def partition(count, seq):
@@ -139,8 +128,7 @@ def partition(count, seq):
         A list representing a partition of `count` elements.
     """
 
-    if not isinstance(seq, collections.Iterator):
-        seq = iter(seq)
+    seq = iter(seq)  # an iterator is its own iterator, so this only changes iterables
     partition = take(count, seq)
     while partition:
         yield partition
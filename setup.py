@@ -1,23 +1,143 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import shlex
+import sys
 
 try:
-    from setuptools import setup
+    from setuptools import setup, Extension
+    from setuptools.command.build_py import build_py
 except ImportError:
-    from distutils.core import setup
+    from distutils.core import setup, Extension
+    from distutils.command.build_py import build_py
+
+# The compiled extensions are optional: without Cython, atactk falls
+# back to its pure Python implementations.
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+
+# The BAM reading extension needs pysam's headers and links against
+# its libraries, so it's only built when pysam is importable at build
+# time, which in practice means --no-build-isolation; pysam is left out
+# of the build requirements on purpose, since an extension linked
+# against an isolated build environment's pysam breaks once that
+# environment is gone. See make_bamscan_extension.
+try:
+    import pysam
+except ImportError:
+    pysam = None
 
 
 readme = open('README.rst').read()
 
 requirements = [
+    'numpy',
     'pyBigWig',
-    'pysam>=0.10.0',
-    'python-levenshtein',
+    'pysam>=0.20',
+    'rapidfuzz>=2.0',
     'sexpdata',
 ]
 
-test_requirements = []
+test_requirements = ['pytest']
+
+# The extensions are integer-only, so -ffast-math can't help them, and
+# wheels have to run on any CPU, so no -march or -mcpu, which would also
+# follow the build host rather than the target when cross-compiling: set
+# CFLAGS=-march=native for a local build if you want one.
+if sys.platform == 'win32':
+    extra_compile_args = ['/O2']
+else:
+    extra_compile_args = ['-O3', '-funroll-loops']
+
+extensions = [
+    Extension('atactk._cutmatrix', ['atactk/_cutmatrix.pyx'], extra_compile_args=extra_compile_args),
+    Extension('atactk._trim', ['atactk/_trim.pyx'], extra_compile_args=extra_compile_args),
+]
+
+
+def make_bamscan_extension():
+    """
+    Return the extension reading alignments through pysam's C API, or None if it can't be built.
+
+    It cimports pysam's Cython declarations, which pysam only installs
+    from 0.20 on, and links against the htslib bundled with pysam.
+    HTSLIB_CFLAGS and HTSLIB_LIBS override pysam's flags, e.g. to link
+    against a system htslib.
+    """
+    if pysam is None:
+        return None
+
+    if not os.path.exists(os.path.join(os.path.dirname(pysam.__file__), 'libchtslib.pxd')):
+        print('pysam {} was installed without its Cython declarations; not building atactk._bamscan'.format(pysam.__version__))
+        return None
+
+    return Extension(
+        'atactk._bamscan',
+        ['atactk/_bamscan.pyx'],
+        include_dirs=pysam.get_include(),
+        define_macros=pysam.get_defines(),
+        extra_compile_args=extra_compile_args + shlex.split(os.environ.get('HTSLIB_CFLAGS', '')),
+        extra_link_args=shlex.split(os.environ['HTSLIB_LIBS']) if 'HTSLIB_LIBS' in os.environ else pysam.get_libraries(),
+    )
+
+
+bamscan_extension = make_bamscan_extension()
+if bamscan_extension:
+    extensions.append(bamscan_extension)
+
+compiler_directives = {
+    'boundscheck': False,
+    'wraparound': False,
+    'cdivision': True,
+    'language_level': 3,
+}
+
+# The command line programs are ordinary Python, compiled as is when
+# Cython is available, so they keep Python's indexing semantics.
+cli_extensions = [
+    Extension('atactk.cli.cut_matrix', ['atactk/cli/cut_matrix.py'], extra_compile_args=extra_compile_args),
+    Extension('atactk.cli.trim_adapters', ['atactk/cli/trim_adapters.py'], extra_compile_args=extra_compile_args),
+]
+
+# Cython's cache (in ~/.cython, or CYTHON_CACHE_DIR) skips translating
+# sources that haven't changed since the last build, e.g. when building
+# wheels for several Python versions. Translating in parallel needs
+# fork, so it's only done on Linux.
+cythonize_options = {
+    'cache': True,
+    'nthreads': os.cpu_count() if sys.platform.startswith('linux') else 0,
+}
+
+if cythonize:
+    ext_modules = cythonize(extensions, compiler_directives=compiler_directives, **cythonize_options)
+    ext_modules += cythonize(cli_extensions, compiler_directives={'language_level': 3}, **cythonize_options)
+else:
+    ext_modules = []
+
+packages = ['atactk', 'atactk.cli', 'atactk.metrics']
+
+
+class build_py_skip_superseded(build_py):
+    """
+    Leave out modules that can never be imported.
+
+    A module is superseded by a package of the same name (like the old
+    ``atactk/metrics.py`` by ``atactk/metrics/``) or by a compiled
+    extension, either of which Python finds first. Not installing them
+    saves compiling their bytecode on every install.
+    """
+
+    def find_package_modules(self, package, package_dir):
+        superseded = set(packages) | {extension.name for extension in ext_modules}
+        return [
+            (module_package, module, filename)
+            for module_package, module, filename in build_py.find_package_modules(self, package, package_dir)
+            if '{}.{}'.format(module_package, module) not in superseded
+        ]
+
 
 setup(
     name='atactk',
@@ -27,19 +147,31 @@ setup(
     author="The Parker Lab",
     author_email='parkerlab-software@umich.edu',
     url='https://github.com/ParkerLab/atactk',
-    packages=['atactk', 'atactk.metrics'],
+    packages=packages,
+    ext_modules=ext_modules,
+    cmdclass={'build_py': build_py_skip_superseded},
+    entry_points={
+        'console_scripts': [
+            'make_cut_matrix=atactk.cli.cut_matrix:main',
+            'trim_adapters=atactk.cli.trim_adapters:main',
+        ],
+    },
     scripts=[
-        'scripts/make_cut_matrix',
         'scripts/make_midpoint_matrix',
         'scripts/measure_features',
         'scripts/measure_signal',
         'scripts/plot_aggregate_cut_matrix.R',
         'scripts/plot_aggregate_midpoint_matrix.R',
         'scripts/plot_signal.R',
-        'scripts/trim_adapters',
     ],
     include_package_data=True,
+    # the extensions' sources are only needed to build them
+    exclude_package_data={'atactk': ['*.pyx', '*.c'], 'atactk.cli': ['*.c']},
+    python_requires='>=3.8',
     install_requires=requirements,
+    extras_require={
+        'numba': ['numba'],
+    },
     license="GPLv3+",
     zip_safe=False,
     keywords='atactk',
@@ -48,10 +180,12 @@ setup(
         'Intended Audience :: Science/Research',
         'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
         'Natural Language :: English',
-        "Programming Language :: Python :: 2",
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
     test_suite='tests',
     tests_require=test_requirements
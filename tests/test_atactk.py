@@ -10,7 +10,7 @@ Tests for `atactk` module.
 
 import unittest
 
-from atactk import atactk
+import atactk
 
 
 class TestAtactk(unittest.TestCase):
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_extensions
+----------------------------------
+
+Tests that the compiled extensions agree with the pure Python
+versions atactk falls back to without them.
+"""
+
+import random
+
+import numpy as np
+import pytest
+
+import atactk.metrics.common as common
+import atactk.metrics.cut as cut
+
+
+BINS = np.array([[36, 149, 1], [150, 224, 2], [225, 324, 2], [325, 400, 5]], dtype=np.int64)
+
+INCLUDE_FLAGS = [83, 99, 147, 163]
+EXCLUDE_FLAGS = [4, 8]
+
+
+def random_cut_points(rng, count, start, end):
+    # some of the cut points fall outside the region, which must be ignored
+    cut_points = rng.integers(start - 50, end + 50, count).astype(np.int64)
+    cut_points[:3] = [-4000000, 5000000, end]
+    fragment_sizes = rng.integers(0, 500, count).astype(np.int64)
+    is_reverse = rng.integers(0, 2, count).astype(np.bool_)
+    return cut_points, fragment_sizes, is_reverse
+
+
+def count_cut_points_with_numpy(monkeypatch, *arguments):
+    with monkeypatch.context() as m:
+        m.setattr(cut, '_cutmatrix', None)
+        m.setattr(cut, '_get_count_cut_points_in_bins_kernel', lambda: None)
+        return cut.count_cut_points_in_bins(*arguments)
+
+
+@pytest.mark.parametrize('count', [0, 1, 200, 5000])
+@pytest.mark.parametrize('feature_is_reverse', [False, True])
+def test_cutmatrix_matches_numpy(monkeypatch, count, feature_is_reverse):
+    _cutmatrix = pytest.importorskip('atactk._cutmatrix')
+    rng = np.random.default_rng(count)
+    start, end = 1000, 1201
+    cut_points, fragment_sizes, is_reverse = random_cut_points(rng, max(count, 3), start, end)
+    cut_points, fragment_sizes, is_reverse = cut_points[:count], fragment_sizes[:count], is_reverse[:count]
+    arguments = (cut_points, fragment_sizes, is_reverse, BINS, start, end, feature_is_reverse)
+
+    expected = count_cut_points_with_numpy(monkeypatch, *arguments)
+    assert expected.shape == (len(BINS), 2, end - start)
+
+    with monkeypatch.context() as m:
+        m.setattr(cut, '_cutmatrix', _cutmatrix)
+        np.testing.assert_array_equal(cut.count_cut_points_in_bins(*arguments), expected)
+
+    # called directly, the extension must ignore the cut points outside the region too
+    direct = _cutmatrix.count_cut_points_in_bins(cut_points, fragment_sizes, is_reverse.view(np.uint8), BINS, start, end, feature_is_reverse)
+    np.testing.assert_array_equal(direct, expected)
+
+
+@pytest.mark.parametrize('feature_is_reverse', [False, True])
+def test_numba_kernel_matches_numpy(monkeypatch, feature_is_reverse):
+    pytest.importorskip('numba')
+    rng = np.random.default_rng(1)
+    start, end = 0, 201
+    cut_points, fragment_sizes, is_reverse = random_cut_points(rng, 1000, start, end)
+    arguments = (cut_points, fragment_sizes, is_reverse, BINS, start, end, feature_is_reverse)
+
+    expected = count_cut_points_with_numpy(monkeypatch, *arguments)
+
+    with monkeypatch.context() as m:
+        m.setattr(cut, '_cutmatrix', None)
+        np.testing.assert_array_equal(cut.count_cut_points_in_bins(*arguments), expected)
+
+    direct = cut._get_count_cut_points_in_bins_kernel()(*arguments)
+    np.testing.assert_array_equal(direct, expected)
+
+
+def python_fuzzy_align(monkeypatch, trim_adapters, *arguments):
+    with monkeypatch.context() as m:
+        m.setattr(trim_adapters, '_trim', None)
+        return trim_adapters.fuzzy_align(*arguments)
+
+
+def test_trim_matches_python(monkeypatch):
+    _trim = pytest.importorskip('atactk._trim')
+    trim_adapters = pytest.importorskip('atactk.cli.trim_adapters')
+
+    rng = random.Random(0)
+    cases = [
+        (b'ACGT', b'', 1),
+        (b'ACGT', b'AC', 2),
+        (b'ACGT', b'TTACGTTT', 0),
+        (b'ACGT', b'TTAGGTTT', 0),
+        (b'ACGTACGTAC', b'ACGTACGTAC', 3),
+    ]
+    for i in range(2000):
+        search_seq = bytes(rng.choice(b'ACGTN') for _ in range(rng.randint(1, 20)))
+        target_seq = bytes(rng.choice(b'ACGTN') for _ in range(rng.randint(0, 60)))
+        # plant a mutated copy of the search sequence in most targets
+        if target_seq and rng.random() < 0.8:
+            planted = bytearray(search_seq)
+            for _ in range(rng.randint(0, 3)):
+                planted[rng.randrange(len(planted))] = rng.choice(b'ACGT')
+            position = rng.randrange(len(target_seq))
+            target_seq = target_seq[:position] + bytes(planted) + target_seq[position:]
+        cases.append((search_seq, target_seq, rng.randint(0, 4)))
+
+    for search_seq, target_seq, max_distance in cases:
+        expected = python_fuzzy_align(monkeypatch, trim_adapters, search_seq, target_seq, max_distance)
+        assert _trim.fuzzy_align(search_seq, target_seq, max_distance) == expected, (search_seq, target_seq, max_distance)
+
+
+def test_trim_accepts_str(monkeypatch):
+    pytest.importorskip('atactk._trim')
+    trim_adapters = pytest.importorskip('atactk.cli.trim_adapters')
+
+    for search_seq, target_seq, max_distance in [('ACGT', 'TTAGGTTT', 1), ('ACGT', b'TTACGTTT', 0), (b'ACGT', 'TTTT', 1)]:
+        expected = python_fuzzy_align(monkeypatch, trim_adapters, search_seq, target_seq, max_distance)
+        assert trim_adapters.fuzzy_align(search_seq, target_seq, max_distance) == expected, (search_seq, target_seq, max_distance)
+
+
+@pytest.fixture(scope='module')
+def alignment_filename(tmp_path_factory):
+    pysam = pytest.importorskip('pysam')
+
+    filename = str(tmp_path_factory.mktemp('bam') / 'test.bam')
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 20000}, {'SN': 'chr2', 'LN': 20000}]}
+    # mapped reads with an empty CIGAR, and unmapped reads placed by their mates, have no reference end
+    cigars = [[(0, 50)], [(4, 5), (0, 40), (2, 3), (0, 5)], [(0, 20), (1, 2), (0, 28)], [(0, 10), (3, 100), (0, 40)], []]
+    flags = [83, 99, 147, 163, 99 | 1024, 83 | 256, 99 | 8, 4 | 1, 1 | 4 | 8 | 32 | 64, 1 | 4 | 16 | 128, 81, 161, 0, 16]
+
+    rng = random.Random(0)
+    with pysam.AlignmentFile(filename, 'wb', header=header) as alignment_file:
+        for i, position in enumerate(sorted(rng.randrange(0, 10000) for _ in range(3000))):
+            segment = pysam.AlignedSegment()
+            segment.query_name = 'read{}'.format(i)
+            segment.flag = rng.choice(flags)
+            segment.reference_id = 0
+            segment.reference_start = position
+            segment.mapping_quality = rng.randint(0, 60)
+            if not segment.is_unmapped:
+                cigar = rng.choice(cigars)
+                segment.cigartuples = cigar
+                segment.query_sequence = 'A' * (sum(length for operation, length in cigar if operation in (0, 1, 4)) or 50)
+            segment.template_length = rng.randint(-600, 600)
+            alignment_file.write(segment)
+    pysam.index(filename)
+    return filename
+
+
+def fetch_segment_arrays_with_pysam(monkeypatch, *arguments):
+    with monkeypatch.context() as m:
+        m.setattr(common, '_bamscan', None)
+        return common.fetch_segment_arrays(*arguments)
+
+
+@pytest.mark.parametrize('reference, start, end', [
+    ('chr1', 0, 20000),
+    ('chr1', 0, 1),
+    ('chr1', 5000, 5201),
+    ('chr1', 9990, 12000),
+    ('chr1', 15000, 16000),  # past the last read
+    ('chr2', 0, 20000),  # no reads at all
+])
+@pytest.mark.parametrize('quality', [0, 30])
+@pytest.mark.parametrize('include_flags, exclude_flags', [(INCLUDE_FLAGS, EXCLUDE_FLAGS), ([1], [1024])])
+def test_bamscan_matches_pysam(monkeypatch, alignment_filename, reference, start, end, quality, include_flags, exclude_flags):
+    _bamscan = pytest.importorskip('atactk._bamscan')
+    import atactk.data
+
+    alignment_file = atactk.data.open_alignment_file(alignment_filename)
+    arguments = (alignment_file, reference, start, end, include_flags, exclude_flags, quality)
+
+    expected = fetch_segment_arrays_with_pysam(monkeypatch, *arguments)
+    with monkeypatch.context() as m:
+        m.setattr(common, '_bamscan', _bamscan)
+        actual = common.fetch_segment_arrays(*arguments)
+
+    for actual_array, expected_array in zip(actual, expected):
+        assert actual_array.dtype == expected_array.dtype
+        np.testing.assert_array_equal(actual_array, expected_array)
+
+
+def test_bamscan_rejects_unknown_references(monkeypatch, alignment_filename):
+    _bamscan = pytest.importorskip('atactk._bamscan')
+    import atactk.data
+
+    alignment_file = atactk.data.open_alignment_file(alignment_filename)
+    arguments = (alignment_file, 'chrX', 0, 100, INCLUDE_FLAGS, EXCLUDE_FLAGS, 0)
+
+    with pytest.raises(ValueError):
+        fetch_segment_arrays_with_pysam(monkeypatch, *arguments)
+    with monkeypatch.context() as m:
+        m.setattr(common, '_bamscan', _bamscan)
+        with pytest.raises(ValueError):
+            common.fetch_segment_arrays(*arguments)